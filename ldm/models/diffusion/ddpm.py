@@ -6,6 +6,8 @@ https://github.com/CompVis/taming-transformers
 -- merci
 """
 
+import os
+import bisect
 import torch
 import torch.nn as nn
 import numpy as np
@@ -23,11 +25,14 @@ from ldm.modules.ema import LitEma
 from ldm.modules.distributions.distributions import normal_kl, DiagonalGaussianDistribution
 from ldm.models.autoencoder import VQModelInterface, IdentityFirstStage, AutoencoderKL
 from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like
+from ldm.modules.diffusionmodules.resample import LossAwareSampler
 from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.group_masks import GroupMasksMixin
+from ldm.models.diffusion.group_telemetry import GroupTelemetry
 import copy
 import sys
 # sys.path.append('/home/sliu/project_space/latent-diffusion/ldm/models/diffusion/')
-from .sparse_core import Masking, CosineDecay
+from .sparse_core import Masking, MaskedAdamW, GroupSparseAdamW, CosineDecay
 
 __conditioning_keys__ = {'concat': 'c_concat',
                          'crossattn': 'c_crossattn',
@@ -42,6 +47,22 @@ def get_model_params(model):
 
 def set_model_params(model, model_parameters):
     model.load_state_dict(model_parameters)
+
+
+def select_batch(c, index):
+    """Selects the samples `index` of a conditioning, which may be nested in lists and dicts."""
+    if isinstance(c, dict):
+        return {key: select_batch(value, index) for key, value in c.items()}
+    if isinstance(c, (list, tuple)):
+        if all(isinstance(value, (torch.Tensor, dict, list, tuple)) for value in c):
+            return [select_batch(value, index) for value in c]
+        # one entry per sample, e.g. captions
+        return [c[i] for i in index.tolist()]
+    if isinstance(c, torch.Tensor):
+        return c[index]
+    return c
+
+
 def disabled_train(self, mode=True):
     """Overwrite model.train with this function to make sure train/eval mode
     does not change anymore."""
@@ -100,6 +121,8 @@ class DDPM(pl.LightningModule):
         if self.use_ema:
             self.model_ema = LitEma(self.model)
             print(f"Keeping EMAs of {len(list(self.model_ema.buffers()))}.")
+        # where ema_scope keeps the training weights, on their own device if None
+        self.ema_store_device = None
 
         self.use_scheduler = scheduler_config is not None
         if self.use_scheduler:
@@ -184,7 +207,7 @@ class DDPM(pl.LightningModule):
     @contextmanager
     def ema_scope(self, context=None):
         if self.use_ema:
-            self.model_ema.store(self.model.parameters())
+            self.model_ema.store(self.model.parameters(), device=self.ema_store_device)
             self.model_ema.copy_to(self.model)
             if context is not None:
                 print(f"{context}: Switched to EMA weights")
@@ -434,7 +457,7 @@ class DDPM(pl.LightningModule):
         return opt
 
 
-class LatentDiffusion(DDPM):
+class LatentDiffusion(GroupMasksMixin, DDPM):
     """main class"""
     def __init__(self,
                  first_stage_config,
@@ -453,11 +476,30 @@ class LatentDiffusion(DDPM):
                  sparse_init='ERK',
                  init_density=0.3,
                  num_mask=10,
+                 masked_update=False,
+                 group_optimizer=False,
+                 nm_sparsity=(2, 4),
+                 mask_plan=None,
+                 mask_generator='torch',
+                 generator_device=None,
+                 flat_buffers=False,
+                 mixed_groups=False,
+                 timestep_boundaries=None,
+                 importance_sampling=False,
+                 importance_history=10,
+                 telemetry_every=None,
                  *args, **kwargs):
         # initializing masks
         self.sparse = sparse
         self.group = group
         self.num_mask = num_mask
+        self.mask_plan = mask_plan
+        self.masked_update = masked_update
+        self.group_optimizer = group_optimizer
+        # draw t over the full range and train every group on its part of the batch
+        self.mixed_groups = mixed_groups
+        if mixed_groups and not (sparse and group and masked_update and not group_optimizer):
+            raise ValueError("mixed_groups needs sparse, group and masked_update, and does not support group_optimizer")
         self.num_timesteps_cond = default(num_timesteps_cond, 1)
         self.scale_by_std = scale_by_std
         assert self.num_timesteps_cond <= kwargs['timesteps']
@@ -485,6 +527,18 @@ class LatentDiffusion(DDPM):
         self.cond_stage_forward = cond_stage_forward
         self.clip_denoised = False
         self.bbox_tokenizer = None  
+        # first timestep of every group followed by num_timesteps
+        self.group_boundaries = self.make_group_boundaries(timestep_boundaries) if group else None
+        # draw groups, or timesteps without groups, in proportion to their recent losses
+        self.timestep_sampler = None
+        if importance_sampling:
+            self.timestep_sampler = LossAwareSampler(self.num_mask if group else self.num_timesteps,
+                                                     history=importance_history)
+        # per-group statistics logged every `telemetry_every` steps, over 10 even ranges of t without groups
+        self.telemetry_every = telemetry_every
+        self.telemetry = None
+        if telemetry_every:
+            self.telemetry = GroupTelemetry(self.group_boundaries if group else self.make_group_boundaries(num_groups=10))
 
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
@@ -494,11 +548,96 @@ class LatentDiffusion(DDPM):
         if self.sparse:
             self.automatic_optimization = False  # enable munual optimization
             self.mask = Masking(None, train_loader=None, prune_mode='magnitude', prune_rate_decay=None, growth_mode='random', \
-                           redistribution_mode=None, fix=fix, fp16=False, sparse_init=sparse_init, init_density=init_density, num_mask=self.num_mask)
+                           redistribution_mode=None, fix=fix, fp16=False, sparse_init=sparse_init, init_density=init_density, num_mask=self.num_mask, \
+                           nm_sparsity=tuple(nm_sparsity), mask_generator=mask_generator, \
+                           generator_device=generator_device, flat_buffers=flat_buffers)
             self.mask.add_module(self.model)
+            if self.mask_plan is not None and os.path.exists(self.mask_plan + '.json'):
+                # reuse the layer densities and masks of an earlier run
+                self.mask.load_mask_plan(self.mask_plan)
             # self.mask.init(mode='ERK', density=self.mask.init_density, mask_index=0)
+            if self.masked_update:
+                # mask weights in the forward pass and update only active entries,
+                # so no dense copy of the weights is needed around each step
+                self.mask.enable_masked_forward()
+
+    def make_group_boundaries(self, boundaries=None, num_groups=None):
+        """Returns [0, *boundaries, num_timesteps], group i covers the timesteps from entry i
+        up to entry i + 1. Without `boundaries` the `num_groups` (default num_mask) groups
+        split the timesteps evenly."""
+        num_groups = default(num_groups, self.num_mask)
+        if boundaries is None:
+            step = self.num_timesteps // num_groups
+            boundaries = [i * step for i in range(1, num_groups)]
+        boundaries = [0] + [int(b) for b in boundaries] + [self.num_timesteps]
+        if len(boundaries) != num_groups + 1 or any(a >= b for a, b in zip(boundaries, boundaries[1:])):
+            raise ValueError(f"Expected {num_groups - 1} increasing timestep boundaries between 0 and "
+                             f"{self.num_timesteps}, got {boundaries[1:-1]}")
+        return boundaries
+
+    def timestep_groups(self, t):
+        """Group index of every timestep of `t`."""
+        return torch.bucketize(t, torch.tensor(self.group_boundaries[1:-1], device=t.device), right=True)
+
+    def sample_group_timesteps(self, mask_index, batch_size):
+        return torch.randint(self.group_boundaries[mask_index], self.group_boundaries[mask_index + 1],
+                             (batch_size,), device=self.device).long()
+
+    def sample_group(self):
+        """Mask index of a training step and the weight of its losses, None if unweighted."""
+        if self.timestep_sampler is None or not self.training:
+            return int(torch.randint(0, self.num_mask, (1,))), None
+        mask_index, weights = self.timestep_sampler.sample(1)
+        return int(mask_index), weights
+
+    def sample_timesteps(self, batch_size):
+        """Timesteps of a training batch and the weights of their losses, None if unweighted.
+        With groups the importance sampler draws a group per sample and t is uniform within it."""
+        if self.timestep_sampler is None or not self.training:
+            return torch.randint(0, self.num_timesteps, (batch_size,), device=self.device).long(), None
+        bins, weights = self.timestep_sampler.sample(batch_size)
+        if not self.group:
+            return bins, weights
+        boundaries = torch.tensor(self.group_boundaries, device=bins.device)
+        start, end = boundaries[bins], boundaries[bins + 1]
+        t = start + (torch.rand(batch_size, device=bins.device) * (end - start)).long()
+        return t, weights
+
+    def update_timestep_sampler(self, t):
+        if self.timestep_sampler is not None and self.training:
+            bins = self.timestep_groups(t) if self.group else t
+            self.timestep_sampler.update(bins, self.sample_losses)
+
+    def recording_telemetry(self):
+        # only training steps between start_step and end_step are recorded, not validation or sampling
+        return self.telemetry is not None and self.training and self.telemetry.step_start is not None
+
+    def flush_telemetry(self):
+        densities = None
+        if self.sparse and self.group:
+            densities = self.mask.group_densities(range(self.num_mask))
+        metrics = self.telemetry.flush(densities)
+        if self.sparse and self.group:
+            for mask_index, updates in enumerate(self.mask.mask_updates.tolist()):
+                metrics[f'groups/{mask_index}/mask_updates'] = updates
+        return metrics
+
+    def on_train_batch_end(self, *args, **kwargs):
+        super().on_train_batch_end(*args, **kwargs)
+        if self.telemetry is not None:
+            self.telemetry.end_step()
+            if len(self.telemetry.pending_steps) >= self.telemetry_every:
+                self.log_dict(self.flush_telemetry(), prog_bar=False, logger=True, on_step=True, on_epoch=False)
+
+    def timestep_to_mask_index(self, t):
+        if not self.group:
+            # one mask per timestep
+            return int(t)
+        return min(bisect.bisect_right(self.group_boundaries, int(t)) - 1, self.num_mask - 1)
 
     def training_step(self, batch, batch_idx):
+        if self.telemetry is not None:
+            self.telemetry.start_step(self.device)
         if self.automatic_optimization:
             loss, loss_dict = self.shared_step(batch)
 
@@ -514,7 +653,7 @@ class LatentDiffusion(DDPM):
 
         else:
             # print('manual optimization')
-            if self.sparse:
+            if self.sparse and not self.masked_update:
                 self.saved_params = {}
                 for name, tensor in self.model.named_parameters():
                     if name in self.mask.masks:
@@ -537,20 +676,22 @@ class LatentDiffusion(DDPM):
 
             self.manual_backward(loss)
             opt.step()
+            if self.sparse and self.mixed_groups:
+                self.mask.update_masks = None
 
-            if self.sparse:
+            if self.sparse and not self.masked_update:
                 self.mask.apply_mask()
 
                 # reload weights before update
                 for name, tensor in self.model.named_parameters():
                     if name in self.mask.masks:
-                        tensor.data.copy_(tensor.data + (1-self.mask.masks[name]).to(tensor.device) * self.saved_params[name].data)
+                        tensor.data.copy_(tensor.data + (~self.mask.masks[name].bool()).to(tensor.device) * self.saved_params[name].data)
 
         return loss
 
     @torch.no_grad()
     def validation_step(self, batch, batch_idx):
-        if self.automatic_optimization:
+        if self.automatic_optimization or self.masked_update:
             _, loss_dict_no_ema = self.shared_step(batch)
             with self.ema_scope():
                 _, loss_dict_ema = self.shared_step(batch)
@@ -985,21 +1126,32 @@ class LatentDiffusion(DDPM):
         # print('manual optimization')
         if not self.sparse: # normal update, no mask, no group
             if self.group:
-                mask_index = int(torch.randint(0, self.num_mask, (1,)))  # mask index and t are the same for each gpu, but x is sampled differently for each gpu
-                t = torch.randint(int(mask_index*(self.num_timesteps//self.num_mask)), int((mask_index+1)*(self.num_timesteps//self.num_mask)), (x.shape[0],), device=self.device).long()
+                mask_index, weights = self.sample_group()  # mask index and t are the same for each gpu, but x is sampled differently for each gpu
+                t = self.sample_group_timesteps(mask_index, x.shape[0])
             else:
-                t = torch.randint(0, self.num_timesteps, (x.shape[0],), device=self.device).long()
+                t, weights = self.sample_timesteps(x.shape[0])
         else:
-            if self.group: # with mask and  group
-                mask_index = int(torch.randint(0, self.num_mask, (1,)))  # mask index and t are the same for each gpu, but x is sampled differently for each gpu
-                t = torch.randint(int(mask_index*(self.num_timesteps//self.num_mask)), int((mask_index+1)*(self.num_timesteps//self.num_mask)), (x.shape[0],), device=self.device).long()
+            if self.group and self.mixed_groups: # with mask and group, one group per sample
+                t, weights = self.sample_timesteps(x.shape[0])
+                # the masks of the groups are only built here, selecting a group is left to the masked forward
+                self.mask.init(mode=self.mask.sparse_init, density=self.mask.init_density, mask_index=0)
+            elif self.group: # with mask and  group
+                mask_index, weights = self.sample_group()  # mask index and t are the same for each gpu, but x is sampled differently for each gpu
+                t = self.sample_group_timesteps(mask_index, x.shape[0])
+                switch_start = self.telemetry.timer() if self.recording_telemetry() and mask_index != self.mask.mask_index else None
                 self.mask.init(mode=self.mask.sparse_init, density=self.mask.init_density, mask_index=int(mask_index))
+                if switch_start is not None:
+                    self.telemetry.add_switch(mask_index, switch_start)
             else: # with mask, but no group, only valid for bs=1
-                t = torch.randint(0, self.num_timesteps, (x.shape[0],), device=self.device).long()
+                t, weights = self.sample_timesteps(x.shape[0])
+                switch_start = self.telemetry.timer() if self.recording_telemetry() else None
                 self.mask.init(mode=self.mask.sparse_init, density=self.mask.init_density, mask_index=t)
+                if switch_start is not None:
+                    self.telemetry.add_switch(self.telemetry.group_of(t), switch_start)
 
             # mask update count +1
-            self.mask.mask_updates[mask_index] += 1
+            if not self.mixed_groups:
+                self.mask.mask_updates[mask_index] += 1
 
         if self.model.conditioning_key is not None:
             assert c is not None
@@ -1008,7 +1160,41 @@ class LatentDiffusion(DDPM):
             if self.shorten_cond_schedule:  # TODO: drop this option
                 tc = self.cond_ids[t].to(self.device)
                 c = self.q_sample(x_start=c, t=tc, noise=torch.randn_like(c.float()))
-        return self.p_losses(x, c, t, *args, **kwargs)
+        if self.sparse and self.mixed_groups:
+            loss, loss_dict = self.mixed_group_losses(x, c, t, *args, weights=weights, **kwargs)
+        else:
+            loss, loss_dict = self.p_losses(x, c, t, *args, weights=weights, **kwargs)
+        self.update_timestep_sampler(t)
+        return loss, loss_dict
+
+    def mixed_group_losses(self, x, c, t, *args, weights=None, **kwargs):
+        """p_losses of a batch whose samples belong to different groups.
+
+        Every group runs on its part of the batch with its own masks, applied by the
+        masked forward hooks, so the weights are never modified. The losses are weighted
+        by the size of each part, which gives the mean over the whole batch. The
+        optimizer then updates the entries active in any of the groups of the batch.
+        """
+        groups = self.timestep_groups(t)
+        group_ids = groups.unique().tolist()
+        if self.training:
+            self.mask.update_masks = self.mask.union_masks(group_ids)
+        loss, loss_dict = 0., {}
+        sample_losses = x.new_empty(x.shape[0])
+        for mask_index in group_ids:
+            index = (groups == mask_index).nonzero(as_tuple=True)[0]
+            # checkpointed blocks recompute with the masks of this group in the backward pass
+            with self.mask.use_forward_masks(self.mask.get_group_masks(mask_index)):
+                group_loss, group_loss_dict = self.p_losses(x[index], select_batch(c, index), t[index], *args,
+                                                            weights=None if weights is None else weights[index], **kwargs)
+            sample_losses[index] = self.sample_losses
+            weight = index.numel() / x.shape[0]
+            loss = loss + weight * group_loss
+            for key, value in group_loss_dict.items():
+                loss_dict[key] = loss_dict.get(key, 0.) + weight * value
+            self.mask.mask_updates[mask_index] += 1
+        self.sample_losses = sample_losses
+        return loss, loss_dict
 
     def _rescale_annotations(self, bboxes, crop_coordinates):  # TODO: move to dataset
         def rescale_bbox(bbox):
@@ -1021,6 +1207,9 @@ class LatentDiffusion(DDPM):
         return [rescale_bbox(b) for b in bboxes]
 
     def apply_model(self, x_noisy, t, cond, return_ids=False):
+        return self.manual_forward(self.model, x_noisy, t, cond, return_ids)
+
+    def manual_forward(self, model, x_noisy, t, cond, return_ids=False):
 
         if isinstance(cond, dict):
             # hybrid case, cond is exptected to be a dict
@@ -1028,7 +1217,7 @@ class LatentDiffusion(DDPM):
         else:
             if not isinstance(cond, list):
                 cond = [cond]
-            key = 'c_concat' if self.model.conditioning_key == 'concat' else 'c_crossattn'
+            key = 'c_concat' if model.conditioning_key == 'concat' else 'c_crossattn'
             cond = {key: cond}
 
         if hasattr(self, "split_input_params"):
@@ -1047,7 +1236,7 @@ class LatentDiffusion(DDPM):
             z_list = [z[:, :, :, :, i] for i in range(z.shape[-1])]
 
             if self.cond_stage_key in ["image", "LR_image", "segmentation",
-                                       'bbox_img'] and self.model.conditioning_key:  # todo check for completeness
+                                       'bbox_img'] and model.conditioning_key:  # todo check for completeness
                 c_key = next(iter(cond.keys()))  # get key
                 c = next(iter(cond.values()))  # get value
                 assert (len(c) == 1)  # todo extend to list with more than one elem
@@ -1104,7 +1293,7 @@ class LatentDiffusion(DDPM):
                 cond_list = [cond for i in range(z.shape[-1])]  # Todo make this more efficient
 
             # apply model by loop over crops
-            output_list = [self.model(z_list[i], t, **cond_list[i]) for i in range(z.shape[-1])]
+            output_list = [model(z_list[i], t, **cond_list[i]) for i in range(z.shape[-1])]
             assert not isinstance(output_list[0],
                                   tuple)  # todo cant deal with multiple model outputs check this never happens
 
@@ -1116,7 +1305,7 @@ class LatentDiffusion(DDPM):
             x_recon = fold(o) / normalization
 
         else:
-            x_recon = self.model(x_noisy, t, **cond)
+            x_recon = model(x_noisy, t, **cond)
 
         if isinstance(x_recon, tuple) and not return_ids:
             return x_recon[0]
@@ -1141,7 +1330,7 @@ class LatentDiffusion(DDPM):
         kl_prior = normal_kl(mean1=qt_mean, logvar1=qt_log_variance, mean2=0.0, logvar2=0.0)
         return mean_flat(kl_prior) / np.log(2.0)
 
-    def p_losses(self, x_start, cond, t, noise=None):
+    def p_losses(self, x_start, cond, t, noise=None, weights=None):
         noise = default(noise, lambda: torch.randn_like(x_start))
         x_noisy = self.q_sample(x_start=x_start, t=t, noise=noise)
         model_output = self.apply_model(x_noisy, t, cond)
@@ -1158,6 +1347,8 @@ class LatentDiffusion(DDPM):
 
         loss_simple = self.get_loss(model_output, target, mean=False).mean([1, 2, 3])
         loss_dict.update({f'{prefix}/loss_simple': loss_simple.mean()})
+        # per-sample losses for the importance sampler
+        self.sample_losses = loss_simple.detach()
 
         logvar_t = self.logvar[t].to(self.device)
         loss = loss_simple / torch.exp(logvar_t) + logvar_t
@@ -1166,10 +1357,18 @@ class LatentDiffusion(DDPM):
             loss_dict.update({f'{prefix}/loss_gamma': loss.mean()})
             loss_dict.update({'logvar': self.logvar.data.mean()})
 
+        if weights is not None:
+            # importance sampled t, weighted to keep the loss unbiased
+            loss = loss * weights
         loss = self.l_simple_weight * loss.mean()
 
         loss_vlb = self.get_loss(model_output, target, mean=False).mean(dim=(1, 2, 3))
-        loss_vlb = (self.lvlb_weights[t] * loss_vlb).mean()
+        loss_vlb = self.lvlb_weights[t] * loss_vlb
+        if self.recording_telemetry():
+            self.telemetry.add_samples(t, loss_simple, loss_vlb)
+        if weights is not None:
+            loss_vlb = loss_vlb * weights
+        loss_vlb = loss_vlb.mean()
         loss_dict.update({f'{prefix}/loss_vlb': loss_vlb})
         loss += (self.original_elbo_weight * loss_vlb)
         loss_dict.update({f'{prefix}/loss': loss})
@@ -1490,16 +1689,25 @@ class LatentDiffusion(DDPM):
                 return {key: log[key] for key in return_keys}
         return log
 
+    def trainable_model_parameters(self):
+        return list(self.model.parameters())
+
     def configure_optimizers(self):
         lr = self.learning_rate
-        params = list(self.model.parameters())
+        params = self.trainable_model_parameters()
         if self.cond_stage_trainable:
             print(f"{self.__class__.__name__}: Also optimizing conditioner params!")
             params = params + list(self.cond_stage_model.parameters())
         if self.learn_logvar:
             print('Diffusion model optimizing logvar')
             params.append(self.logvar)
-        opt = torch.optim.AdamW(params, lr=lr)
+        if self.sparse and self.masked_update and self.group_optimizer:
+            # separate moments for the active entries of every group
+            opt = GroupSparseAdamW(params, masking=self.mask, lr=lr)
+        elif self.sparse and self.masked_update:
+            opt = MaskedAdamW(params, masking=self.mask, lr=lr)
+        else:
+            opt = torch.optim.AdamW(params, lr=lr)
         if self.use_scheduler:
             assert 'target' in self.scheduler_config
             scheduler = instantiate_from_config(self.scheduler_config)
@@ -24,6 +24,7 @@ from ldm.modules.distributions.distributions import normal_kl, DiagonalGaussianD
 from ldm.models.autoencoder import VQModelInterface, IdentityFirstStage, AutoencoderKL
 from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like
 from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.ddpm import select_batch
 
 
 __conditioning_keys__ = {'concat': 'c_concat',
@@ -897,13 +898,20 @@ class LatentDiffusion(DDPM):
         return [rescale_bbox(b) for b in bboxes]
 
     def apply_model(self, x_noisy, t, cond, return_ids=False):
+        # samples with t < 500 are denoised by self.model, the others by self.model2. Each UNet
+        # only runs on its own samples, and a batch with all t on one side runs a single UNet
         msk = t < 500
-        msk = msk.reshape(-1, 1, 1, 1)
-        res1 = self.manual_forward(self.model, x_noisy, t, cond, return_ids)
-        res2 = self.manual_forward(self.model2, x_noisy, t, cond, return_ids)
-        # print(res1.shape, res2.shape, t.shape, msk.shape)
-        # ?it/s]torch.Size([48, 4, 32, 32]) torch.Size([48, 4, 32, 32]) torch.Size([48]) torch.Size([48])
-        res = res1 * msk + res2 * (~msk)
+        index1 = msk.nonzero(as_tuple=True)[0]
+        if len(index1) == len(t):
+            return self.manual_forward(self.model, x_noisy, t, cond, return_ids)
+        if len(index1) == 0:
+            return self.manual_forward(self.model2, x_noisy, t, cond, return_ids)
+        index2 = (~msk).nonzero(as_tuple=True)[0]
+        res1 = self.manual_forward(self.model, x_noisy[index1], t[index1], select_batch(cond, index1), return_ids)
+        res2 = self.manual_forward(self.model2, x_noisy[index2], t[index2], select_batch(cond, index2), return_ids)
+        res = res1.new_empty((len(t),) + res1.shape[1:])
+        res[index1] = res1
+        res[index2] = res2
         return res
     
     def manual_forward(self, model, x_noisy, t, cond, return_ids=False):
@@ -0,0 +1,206 @@
+"""
+LatentDiffusion with one denoiser per range of timesteps, generalizing ddpm_2dense to any
+number of experts and to masked subnetworks of one UNet.
+"""
+
+import bisect
+import torch
+import torch.nn as nn
+from contextlib import contextmanager
+
+from ldm.modules.ema import LitEma
+from ldm.models.diffusion.ddpm import LatentDiffusion as GroupLatentDiffusion, DiffusionWrapper, select_batch
+from ldm.models.diffusion.expert_residency import ExpertResidency
+
+
+class LatentDiffusion(GroupLatentDiffusion):
+    """LatentDiffusion with `num_experts` denoisers, each covering a range of timesteps.
+
+    Expert i denoises the timesteps from expert_boundaries[i - 1] up to expert_boundaries[i],
+    the experts split the timesteps evenly if no boundaries are given. The experts are
+    separate UNets or, with `sparse` and `group` set, masked subnetworks of one UNet, i.e.
+    the groups of ddpm.LatentDiffusion with num_mask=num_experts. With `group` set every
+    step trains a single expert, otherwise t is drawn over all timesteps. Either way every
+    sample only runs through its own expert, so a step costs one UNet forward whatever
+    the number of experts.
+
+    Expert 0 is `self.model`, the other UNets are `self.experts` with their EMAs in
+    `self.experts_ema`, so checkpoints hold one section per expert. See
+    `expand_expert_state_dict` for checkpoints with fewer experts.
+
+    With `offload_experts`, the DDIM and PLMS samplers only keep the UNet of the expert
+    they sample with on the device, see `ExpertResidency`. The other experts and the EMAs
+    stay parked on the host after sampling, until the next training batch.
+    """
+    def __init__(self, num_experts=2, expert_boundaries=None, offload_experts=False, *args, **kwargs):
+        self.num_experts = num_experts
+        if kwargs.get('group', False):
+            # the groups are the experts
+            kwargs['num_mask'] = num_experts
+            kwargs['timestep_boundaries'] = expert_boundaries
+        self.masked_experts = kwargs.get('sparse', False)
+        if self.masked_experts and not kwargs.get('group', False):
+            raise ValueError("Masked experts need group, the masks only cover one UNet")
+        ckpt_path = kwargs.pop("ckpt_path", None)
+        ignore_keys = kwargs.pop("ignore_keys", [])
+        super().__init__(*args, **kwargs)
+        # first timestep of every expert followed by num_timesteps
+        self.expert_boundaries = self.group_boundaries if self.group else \
+            self.make_group_boundaries(expert_boundaries, num_experts)
+
+        self.experts = nn.ModuleList()
+        if not self.masked_experts:
+            self.experts.extend(DiffusionWrapper(kwargs['unet_config'], self.model.conditioning_key)
+                                for _ in range(num_experts - 1))
+        if self.use_ema:
+            self.experts_ema = nn.ModuleList(LitEma(expert) for expert in self.experts)
+        self.expert_residency = None
+        if offload_experts and not self.masked_experts:
+            # the EMAs are copied to the UNets by ema_scope, so they stay parked while sampling,
+            # and so do the training weights ema_scope keeps aside
+            emas = [self.model_ema] + list(self.experts_ema) if self.use_ema else []
+            self.expert_residency = ExpertResidency([[self.get_expert(i)] for i in range(num_experts)], parked=emas)
+            self.ema_store_device = 'cpu'
+
+        if ckpt_path is not None:
+            self.init_from_ckpt(ckpt_path, ignore_keys)
+            self.restarted_from_ckpt = True
+
+    def get_expert(self, index):
+        return self.model if index == 0 else self.experts[index - 1]
+
+    def timestep_to_expert(self, t):
+        return min(bisect.bisect_right(self.expert_boundaries, int(t)) - 1, self.num_experts - 1)
+
+    def timestep_experts(self, t):
+        """Expert index of every timestep of `t`."""
+        return torch.bucketize(t, torch.tensor(self.expert_boundaries[1:-1], device=t.device), right=True)
+
+    def apply_model(self, x_noisy, t, cond, return_ids=False):
+        if self.masked_experts:
+            # the masks of the experts are selected by the sparse training and sampling code
+            return super().apply_model(x_noisy, t, cond, return_ids)
+        experts = self.timestep_experts(t)
+        expert_ids = experts.unique().tolist()
+        if self.expert_residency is not None:
+            # experts parked by an earlier sampling run
+            for expert_id in expert_ids:
+                self.expert_residency.ensure(expert_id)
+        if len(expert_ids) == 1:
+            # e.g. sampling, where the whole batch shares t
+            return self.manual_forward(self.get_expert(expert_ids[0]), x_noisy, t, cond, return_ids)
+        res = None
+        for expert_id in expert_ids:
+            index = (experts == expert_id).nonzero(as_tuple=True)[0]
+            out = self.manual_forward(self.get_expert(expert_id), x_noisy[index], t[index],
+                                      select_batch(cond, index), return_ids)
+            if res is None:
+                res = out.new_empty((len(t),) + out.shape[1:])
+            res[index] = out
+        return res
+
+    @contextmanager
+    def ema_scope(self, context=None):
+        if self.use_ema:
+            for expert, ema in zip(self.experts, self.experts_ema):
+                ema.store(expert.parameters(), device=self.ema_store_device)
+                ema.copy_to(expert)
+        try:
+            with super().ema_scope(context):
+                if self.expert_residency is not None:
+                    self.expert_residency.invalidate()
+                yield None
+        finally:
+            if self.use_ema:
+                for expert, ema in zip(self.experts, self.experts_ema):
+                    ema.restore(expert.parameters())
+            if self.expert_residency is not None:
+                self.expert_residency.invalidate()
+
+    @contextmanager
+    def mask_scope(self, context=None, sparse_kernels=False, min_sparsity=0.5, max_sparse_groups=2):
+        # the experts stay parked after sampling, see on_train_batch_start
+        if self.expert_residency is not None:
+            self.expert_residency.start(self.device)
+        with super().mask_scope(context, sparse_kernels=sparse_kernels, min_sparsity=min_sparsity,
+                                max_sparse_groups=max_sparse_groups):
+            yield None
+
+    def activate_mask_for_timestep(self, t):
+        super().activate_mask_for_timestep(t)
+        if self.expert_residency is not None:
+            self.expert_residency.activate(self.timestep_to_expert(t))
+
+    def prefetch_for_timestep(self, t):
+        # called with the next timestep of the sampler, so the copy overlaps with the current step
+        if self.expert_residency is not None:
+            self.expert_residency.prefetch(self.timestep_to_expert(t))
+
+    def on_train_batch_start(self, *args, **kwargs):
+        # the optimizer and the EMA updates need every expert on the device
+        if self.expert_residency is not None:
+            self.expert_residency.restore()
+        return super().on_train_batch_start(*args, **kwargs)
+
+    def on_train_batch_end(self, *args, **kwargs):
+        super().on_train_batch_end(*args, **kwargs)
+        if self.use_ema:
+            for expert, ema in zip(self.experts, self.experts_ema):
+                ema(expert)
+
+    def trainable_model_parameters(self):
+        return super().trainable_model_parameters() + list(self.experts.parameters())
+
+    def expand_expert_state_dict(self, sd):
+        """Fills the sections of experts missing from a state dict.
+
+        A ddpm_2dense checkpoint provides expert 1 from `model2`, any other missing expert,
+        e.g. of a single-UNet checkpoint, starts as a copy of expert 0. The same goes for
+        the EMAs.
+        """
+        sd = dict(sd)
+        sections = [('experts', 'model')]
+        if self.use_ema:
+            sections.append(('experts_ema', 'model_ema'))
+        for index in range(1, len(self.experts) + 1):
+            for section, source in sections:
+                prefix = f'{section}.{index - 1}.'
+                if any(k.startswith(prefix) for k in sd):
+                    continue
+                sources = [source.replace('model', 'model2'), source] if index == 1 else [source]
+                for source in sources:
+                    keys = [k for k in sd if k.startswith(source + '.')]
+                    if keys:
+                        print(f"Initializing {prefix[:-1]} from {source}")
+                        sd.update({prefix + k[len(source) + 1:]: sd[k] for k in keys})
+                        break
+        return sd
+
+    def init_from_ckpt(self, path, ignore_keys=list(), only_model=False):
+        sd = torch.load(path, map_location="cpu")
+        if "state_dict" in list(sd.keys()):
+            sd = sd["state_dict"]
+        for k in list(sd.keys()):
+            for ik in ignore_keys:
+                if k.startswith(ik):
+                    print("Deleting key {} from state_dict.".format(k))
+                    del sd[k]
+        if only_model:
+            missing, unexpected = self.model.load_state_dict(sd, strict=False)
+        else:
+            missing, unexpected = self.load_state_dict(self.expand_expert_state_dict(sd), strict=False)
+        print(f"Restored from {path} with {len(missing)} missing and {len(unexpected)} unexpected keys")
+        if len(missing) > 0:
+            print(f"Missing Keys: {missing}")
+        if len(unexpected) > 0:
+            print(f"Unexpected Keys: {unexpected}")
+
+    def on_save_checkpoint(self, checkpoint):
+        super().on_save_checkpoint(checkpoint)
+        checkpoint['expert_boundaries'] = self.expert_boundaries
+
+    def on_load_checkpoint(self, checkpoint):
+        super().on_load_checkpoint(checkpoint)
+        boundaries = checkpoint.get('expert_boundaries')
+        if boundaries is not None and list(boundaries) != self.expert_boundaries:
+            raise ValueError(f"Checkpoint has expert boundaries {boundaries}, the model {self.expert_boundaries}")
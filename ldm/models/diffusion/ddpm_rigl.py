@@ -6,6 +6,7 @@ https://github.com/CompVis/taming-transformers
 -- merci
 """
 
+import os
 import torch
 import torch.nn as nn
 import numpy as np
@@ -24,6 +25,7 @@ from ldm.modules.distributions.distributions import normal_kl, DiagonalGaussianD
 from ldm.models.autoencoder import VQModelInterface, IdentityFirstStage, AutoencoderKL
 from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like
 from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.group_masks import GroupMasksMixin
 import copy
 import sys
 # sys.path.append('/home/sliu/project_space/latent-diffusion/ldm/models/diffusion/')
@@ -432,7 +434,7 @@ class DDPM(pl.LightningModule):
         return opt
 
 
-class LatentDiffusion(DDPM):
+class LatentDiffusion(GroupMasksMixin, DDPM):
     """main class"""
     def __init__(self,
                  first_stage_config,
@@ -452,11 +454,13 @@ class LatentDiffusion(DDPM):
                  init_density=0.3,
                  num_mask=10,
                  update_frequency=500,
+                 mask_plan=None,
                  *args, **kwargs):
         # initializing masks
         self.sparse = sparse
         self.group = group
         self.num_mask = num_mask
+        self.mask_plan = mask_plan
         self.num_timesteps_cond = default(num_timesteps_cond, 1)
         self.scale_by_std = scale_by_std
         assert self.num_timesteps_cond <= kwargs['timesteps']
@@ -495,8 +499,16 @@ class LatentDiffusion(DDPM):
             self.mask = Masking(None, train_loader=None, prune_mode='magnitude', prune_rate_decay=None, growth_mode='gradient', \
                            redistribution_mode=None, fix=fix, fp16=False, sparse_init=sparse_init, init_density=init_density, num_mask=self.num_mask, update_frequency=update_frequency)
             self.mask.add_module(self.model)
+            if self.mask_plan is not None and os.path.exists(self.mask_plan + '.json'):
+                self.mask.load_mask_plan(self.mask_plan)
             self.mask.init(mode='ERK_local', density=self.mask.init_density, mask_index=0)
 
+    def timestep_to_mask_index(self, t):
+        if not self.group:
+            # one mask per timestep
+            return int(t)
+        return min(int(t) // (self.num_timesteps // self.num_mask), self.num_mask - 1)
+
     def training_step(self, batch, batch_idx):
         if self.automatic_optimization:
             loss, loss_dict = self.shared_step(batch)
@@ -543,7 +555,11 @@ class LatentDiffusion(DDPM):
                 # perform prune-and-grow
                 if self.mask.mask_update % self.mask.prune_every_k_steps == 0:
                     self.mask.truncate_weights()
-                    self.mask.print_nonzero_counts()
+                    if torch.distributed.is_available() and torch.distributed.is_initialized():
+                        # growth can differ between ranks, e.g. random growth
+                        self.mask.synchronism_masks()
+                    # layer densities and removed counts, read back from the device once
+                    self.log_dict(self.mask.update_metrics(), prog_bar=False, logger=True, on_step=True, on_epoch=False)
 
                 # reload weights before update
                 for name, tensor in self.model.named_parameters():
@@ -998,8 +1014,7 @@ class LatentDiffusion(DDPM):
                 mask_index = int(torch.randint(0, self.num_mask, (1,)))  # mask index and t are the same for each gpu, but x is sampled differently for each gpu
                 t = torch.randint(int(mask_index*(self.num_timesteps//self.num_mask)), int((mask_index+1)*(self.num_timesteps//self.num_mask)), (x.shape[0],), device=self.device).long()
                 # set masks[mask_index] to self.masks
-                self.mask.masks = self.mask.masks_local[mask_index]
-                self.mask.apply_mask()
+                self.mask.switch_mask(mask_index)
             else: # with mask, but no group, only valid for bs=1
                 t = torch.randint(0, self.num_timesteps, (x.shape[0],), device=self.device).long()
                 self.mask.apply_mask()
@@ -19,7 +19,7 @@ from torchvision.utils import make_grid
 from pytorch_lightning.utilities.distributed import rank_zero_only
 
 from ldm.util import log_txt_as_img, exists, default, ismap, isimage, mean_flat, count_params, instantiate_from_config
-from ldm.modules.ema import LitEma
+from ldm.modules.ema import LitEma, update_emas
 from ldm.modules.distributions.distributions import normal_kl, DiagonalGaussianDistribution
 from ldm.models.autoencoder import VQModelInterface, IdentityFirstStage, AutoencoderKL
 from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like
@@ -48,6 +48,13 @@ def disabled_train(self, mode=True):
     return self
 
 
+def multi_tensor_adamw(params, lr):
+    """AdamW updating all parameters of a param group with multi-tensor ops, where torch provides them."""
+    if hasattr(torch.optim, '_multi_tensor'):
+        return torch.optim._multi_tensor.AdamW(params, lr=lr)
+    return torch.optim.AdamW(params, lr=lr)
+
+
 def uniform_on_device(r1, r2, shape, device):
     return (r1 - r2) * torch.rand(*shape, device=device) + r2
 
@@ -184,18 +191,29 @@ class DDPM(pl.LightningModule):
         self.register_buffer('lvlb_weights', lvlb_weights, persistent=False)
         assert not torch.isnan(self.lvlb_weights).all()
 
+    def expert_models(self):
+        return [self.model1, self.model2]
+
+    def expert_emas(self):
+        return [self.model_ema1, self.model_ema2]
+
+    def expert_parameters(self):
+        return [param for model in self.expert_models() for param in model.parameters()]
+
     @contextmanager
     def ema_scope(self, context=None):
         if self.use_ema:
-            self.model_ema.store(self.model.parameters())
-            self.model_ema.copy_to(self.model)
+            for model, ema in zip(self.expert_models(), self.expert_emas()):
+                ema.store(model.parameters())
+                ema.copy_to(model)
             if context is not None:
                 print(f"{context}: Switched to EMA weights")
         try:
             yield None
         finally:
             if self.use_ema:
-                self.model_ema.restore(self.model.parameters())
+                for model, ema in zip(self.expert_models(), self.expert_emas()):
+                    ema.restore(model.parameters())
                 if context is not None:
                     print(f"{context}: Restored training weights")
 
@@ -381,7 +399,8 @@ class DDPM(pl.LightningModule):
 
     def on_train_batch_end(self, *args, **kwargs):
         if self.use_ema:
-            self.model_ema(self.model)
+            # the shadows of all experts in one multi-tensor update
+            update_emas(self.expert_emas(), self.expert_models())
 
     def _get_rows_from_list(self, samples):
         n_imgs_per_row = len(samples)
@@ -430,10 +449,10 @@ class DDPM(pl.LightningModule):
 
     def configure_optimizers(self):
         lr = self.learning_rate
-        params = list(self.model.parameters())
+        params = self.expert_parameters()
         if self.learn_logvar:
             params = params + [self.logvar]
-        opt = torch.optim.AdamW(params, lr=lr)
+        opt = multi_tensor_adamw(params, lr=lr)
         return opt
 
 
@@ -523,11 +542,9 @@ class LatentDiffusion_m(DDPM):
                     if name in self.mask.masks:
                         self.saved_params[name] = copy.deepcopy(tensor)
 
-            opt1, opt2 = self.optimizers()
-
-
-            opt1.zero_grad()
-            opt2.zero_grad()
+            # one optimizer steps the parameters of all experts
+            opt = self.optimizers()
+            opt.zero_grad(set_to_none=True)
 
             loss, loss_dict, t = self.shared_step(batch)
 
@@ -1484,16 +1501,15 @@ class LatentDiffusion_m(DDPM):
 
     def configure_optimizers(self):
         lr = self.learning_rate
-        params1 = list(self.model1.parameters())
-        params2 = list(self.model2.parameters())
+        # a single param group over all experts, so that every step is one multi-tensor update
+        params = self.expert_parameters()
         if self.cond_stage_trainable:
             print(f"{self.__class__.__name__}: Also optimizing conditioner params!")
-            params1 = params1 + list(self.cond_stage_model.parameters())
+            params = params + list(self.cond_stage_model.parameters())
         if self.learn_logvar:
             print('Diffusion model optimizing logvar')
-            params1.append(self.logvar)
-        opt1 = torch.optim.AdamW(params1, lr=lr)
-        opt2 = torch.optim.AdamW(params2, lr=lr)
+            params.append(self.logvar)
+        opt = multi_tensor_adamw(params, lr=lr)
         if self.use_scheduler:
             assert 'target' in self.scheduler_config
             scheduler = instantiate_from_config(self.scheduler_config)
@@ -1501,12 +1517,12 @@ class LatentDiffusion_m(DDPM):
             print("Setting up LambdaLR scheduler...")
             scheduler = [
                 {
-                    'scheduler': LambdaLR(opt1, lr_lambda=scheduler.schedule),
+                    'scheduler': LambdaLR(opt, lr_lambda=scheduler.schedule),
                     'interval': 'step',
                     'frequency': 1
                 }]
-            return [opt1, opt2], scheduler
-        return opt1
+            return [opt], scheduler
+        return opt
 
     @torch.no_grad()
     def to_rgb(self, x):
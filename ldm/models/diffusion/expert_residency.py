@@ -0,0 +1,129 @@
+"""SAMPLING ONLY.
+
+Keeps only the active timestep expert of a model on the accelerator while sampling.
+"""
+
+import itertools
+import torch
+
+
+class ExpertResidency(object):
+    """Parks inactive experts in pinned CPU memory and moves them to the device on demand.
+
+    Every expert is a list of modules whose parameters and buffers move together. `start`
+    parks the experts, `activate` brings one back and parks the others, and `prefetch`
+    starts bringing one back on a side stream, so that the copy overlaps with the sampling
+    steps before the expert is needed. `ensure` brings one back without parking any, e.g.
+    for a forward pass outside sampling. The `parked` modules, e.g. the EMAs of the
+    experts, are parked in `start` as well but only return to the device in `restore`.
+
+    Experts stay parked across sampling runs, so the device only holds the expert in use,
+    until `restore` moves all of them back, e.g. before training. The pinned buffers are
+    allocated when the experts are first parked and released in `restore`. A parked
+    expert lives in its buffers, so changing it needs no copy, and an expert on the device
+    is only copied back to them when parked if it changed since it was brought in, see
+    `invalidate`.
+
+    Nothing is moved unless the experts are on a CUDA device.
+    """
+    def __init__(self, experts, parked=()):
+        self.experts = [list(modules) for modules in experts]
+        self.num_experts = len(self.experts)
+        # the parked modules follow the experts as experts that are never activated
+        self.experts += [[module] for module in parked]
+        self.device = None
+        self.stream = None
+        self.pinned = {}
+        self.resident = set(range(len(self.experts)))
+        # experts on the device that equal their pinned buffers
+        self.clean = set()
+        # expert index -> event recorded on the side stream after its copy
+        self.pending = {}
+
+    def tensors(self, index):
+        return [tensor for module in self.experts[index]
+                for tensor in itertools.chain(module.parameters(), module.buffers())]
+
+    @property
+    def enabled(self):
+        return self.device is not None
+
+    def start(self, device):
+        """Parks all experts if they are not parked yet."""
+        device = torch.device(device)
+        if device.type != 'cuda' or self.enabled:
+            return
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+        self.pending = {}
+        for index in range(len(self.experts)):
+            self.park(index)
+
+    def invalidate(self):
+        """Marks the experts on the device as changed, e.g. after copying EMA weights to them."""
+        self.clean = set()
+
+    def park(self, index):
+        if index not in self.resident:
+            return
+        tensors = self.tensors(index)
+        if index not in self.pinned:
+            self.pinned[index] = [torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True) for tensor in tensors]
+        if index not in self.clean:
+            for tensor, pinned in zip(tensors, self.pinned[index]):
+                pinned.copy_(tensor.data)
+        for tensor, pinned in zip(tensors, self.pinned[index]):
+            tensor.data = pinned
+        self.resident.discard(index)
+        self.clean.discard(index)
+
+    def prefetch(self, index):
+        if not self.enabled or index in self.resident or index in self.pending:
+            return
+        with torch.cuda.stream(self.stream):
+            for tensor, pinned in zip(self.tensors(index), self.pinned[index]):
+                tensor.data = pinned.to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.pending[index] = event
+
+    def wait(self, index):
+        event = self.pending.pop(index, None)
+        if event is None:
+            return
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_event(event)
+        for tensor in self.tensors(index):
+            # the copies were allocated on the side stream, but are used and freed on this one
+            tensor.data.record_stream(current_stream)
+        self.resident.add(index)
+        self.clean.add(index)
+
+    def ensure(self, index):
+        """Brings expert `index` to the device, leaving the other experts where they are."""
+        if not self.enabled:
+            return
+        self.prefetch(index)
+        self.wait(index)
+
+    def activate(self, index):
+        if not self.enabled:
+            return
+        assert index < self.num_experts, f"Parked module {index} can not be activated"
+        self.ensure(index)
+        for other in list(self.resident):
+            if other != index:
+                self.park(other)
+
+    def restore(self):
+        """Moves every expert back to the device and releases the pinned buffers."""
+        if not self.enabled:
+            return
+        for index in range(len(self.experts)):
+            self.ensure(index)
+        # the copies out of the pinned buffers have to finish before they are released
+        torch.cuda.current_stream(self.device).synchronize()
+        self.pinned = {}
+        self.clean = set()
+        self.device = None
+        self.stream = None
@@ -1,5 +1,65 @@
 import torch
 import math
+'''
+                SELECTION
+'''
+
+def topk_indices(scores, k, largest=True):
+    """Flat indices of the k largest (smallest) entries of `scores`, without sorting all of them."""
+    scores = scores.reshape(-1)
+    k = min(int(k), scores.numel())
+    if k <= 0:
+        return torch.zeros(0, dtype=torch.long, device=scores.device)
+    return torch.topk(scores, k, largest=largest, sorted=False)[1]
+
+
+def segmented_topk_masks(buffer, offsets, sizes, ks, largest=True):
+    """Selects the k largest (smallest) entries of every segment buffer[offset:offset + size]
+    of a flat buffer, e.g. the flat buffers of Masking.
+
+    Every segment is selected by one topk on a view of the buffer, so nothing is copied
+    or sorted and no count is read back from the device. Entries outside the segments are
+    never selected. Returns one flat bool mask per segment, views of one selection buffer.
+    """
+    selection = torch.zeros(buffer.numel(), dtype=torch.bool, device=buffer.device)
+    selected = []
+    for offset, size, k in zip(offsets, sizes, ks):
+        mask = selection[offset:offset + size]
+        mask[topk_indices(buffer[offset:offset + size], k, largest=largest)] = True
+        selected.append(mask)
+    return selected
+
+
+def batched_topk_masks(scores, ks, largest=True):
+    """Selects the k largest (smallest) entries of several score tensors at once.
+
+    Score tensors with the same number of entries are stacked into one flattened
+    buffer and share a single topk call, which selects max(k) entries per row and
+    keeps the first k of every row. Returns one bool mask per score tensor.
+    """
+    selected = [None] * len(scores)
+    buckets = {}
+    for i, score in enumerate(scores):
+        buckets.setdefault(score.numel(), []).append(i)
+    for numel, indices in buckets.items():
+        if len(indices) == 1:
+            i = indices[0]
+            selected[i] = torch.zeros(scores[i].shape, dtype=torch.bool, device=scores[i].device)
+            selected[i].view(-1)[topk_indices(scores[i], ks[i], largest=largest)] = True
+            continue
+        layer_ks = [min(max(int(ks[i]), 0), numel) for i in indices]
+        buffer = torch.stack([scores[i].reshape(-1) for i in indices])
+        selection = torch.zeros(buffer.shape, dtype=torch.bool, device=buffer.device)
+        k_max = max(layer_ks)
+        if k_max > 0:
+            idx = torch.topk(buffer, k_max, dim=1, largest=largest, sorted=True)[1]
+            keep = torch.arange(k_max, device=buffer.device) < torch.tensor(layer_ks, device=buffer.device).unsqueeze(1)
+            selection.scatter_(1, idx, keep)
+        for row, i in enumerate(indices):
+            selected[i] = selection[row].view(scores[i].shape)
+    return selected
+
+
 '''
                 REDISTRIBUTION
 '''
@@ -109,41 +169,136 @@ def magnitude_prune(masking, mask, weight, name):
     k = math.ceil(num_zeros + num_remove)
     if num_remove == 0.0: return weight.data != 0.0
 
-    x, idx = torch.sort(torch.abs(weight.data.view(-1)))
-    mask.data.view(-1)[idx[:k]] = 0.0
+    # keeping the largest weights selects far fewer entries than removing the k smallest
+    keep = topk_indices(prune_scores(mask, weight), mask.numel() - k)
+    mask.data.fill_(0)
+    mask.data.view(-1)[keep] = 1
     return mask
 
+
+def prune_scores(mask, weight):
+    # inactive weights score below every active one, so they are the first to be "pruned" again
+    return torch.where(mask.bool(), torch.abs(weight.data), torch.full_like(weight.data, -1.0))
+
+
+def batched_magnitude_prune(masking, names, masks, weights):
+    """`magnitude_prune` of several layers at once, see `batched_topk_masks`, and `segmented_topk_masks`
+    with flat buffers."""
+    num_removes = [math.ceil(masking.prune_rate*masking.name2nonzeros[name]) for name in names]
+    num_keeps = [mask.numel() - math.ceil(masking.name2zeros[name] + num_remove)
+                 for name, mask, num_remove in zip(names, masks, num_removes)]
+    if masking.ensure_flat():
+        # the scores of all layers at once, in the flat layout. The padding between the layers is never kept
+        flat_scores = prune_scores(masking.flat_mask, masking.flat_weights)
+        kept = segmented_topk_masks(flat_scores, [masking.flat_layout[name] for name in names],
+                                    [mask.numel() for mask in masks], num_keeps)
+        kept = [keep.view(mask.shape) for keep, mask in zip(kept, masks)]
+    else:
+        kept = batched_topk_masks([prune_scores(mask, weight) for mask, weight in zip(masks, weights)], num_keeps)
+    return [keep if num_remove > 0 else weight.data != 0.0 for keep, weight, num_remove in zip(kept, weights, num_removes)]
+
 def global_magnitude_prune(masking):
+    """Prunes the prune rate fraction of the baseline nonzeros with the smallest magnitude over all layers.
+
+    The magnitude threshold is the exact k-th smallest score of all layers together,
+    see `global_kth_smallest`, so there is no threshold search and no sync per layer.
+    Returns the number of removed weights.
+    """
     prune_rate = 0.0
     for name in masking.name2prune_rate:
         if name in masking.masks:
             prune_rate = masking.name2prune_rate[name]
     tokill = math.ceil(prune_rate*masking.baseline_nonzero)
-    total_removed = 0
-    prev_removed = 0
-    while total_removed < tokill*(1.0-masking.tolerance) or (total_removed > tokill*(1.0+masking.tolerance)):
-        total_removed = 0
-        for module in masking.modules:
-            for name, weight in module.named_parameters():
-                if name not in masking.masks: continue
-                remain = (torch.abs(weight.data) > masking.prune_threshold).sum().item()
-                total_removed += masking.name2nonzeros[name] - remain
-
-        if prev_removed == total_removed: break
-        prev_removed = total_removed
-        if total_removed > tokill*(1.0+masking.tolerance):
-            masking.prune_threshold *= 1.0-masking.increment
-            masking.increment *= 0.99
-        elif total_removed < tokill*(1.0-masking.tolerance):
-            masking.prune_threshold *= 1.0+masking.increment
-            masking.increment *= 0.99
 
+    names, weights = masked_weights(masking)
+    masks = [masking.masks[name] for name in names]
+    nonzeros = torch.stack([mask.sum() for mask in masks]).tolist()
+    for name, mask, nonzero in zip(names, masks, nonzeros):
+        masking.name2nonzeros[name] = nonzero
+        masking.name2zeros[name] = mask.numel() - nonzero
+        masking.name2removed[name] = 0
+    if tokill <= 0: return 0
+    scores = [prune_scores(mask, weight) for mask, weight in zip(masks, weights)]
+    total = sum(mask.numel() for mask in masks)
+    # the inactive weights score lowest, the tokill smallest active ones follow them
+    k = min(total - sum(nonzeros) + tokill, total)
+    threshold = global_kth_smallest(scores, k, masking.max_selection_numel)
+    for mask, keep in zip(masks, largest_masks(scores, threshold, total - k)):
+        mask[:] = keep
+
+    remaining = torch.stack([mask.sum() for mask in masks]).tolist()
+    for name, nonzero, remain in zip(names, nonzeros, remaining):
+        masking.name2removed[name] = nonzero - remain
+    return int(sum(nonzeros) - sum(remaining))
+
+
+def masked_weights(masking):
+    names, weights = [], []
     for module in masking.modules:
         for name, weight in module.named_parameters():
             if name not in masking.masks: continue
-            masking.masks[name][:] = torch.abs(weight.data) > masking.prune_threshold
-
-    return int(total_removed)
+            names.append(name)
+            weights.append(weight)
+    return names, weights
+
+
+def largest_masks(scores, threshold, count):
+    """Masks of the `count` largest entries of all scores, given that `threshold` is the
+    (total - count)-th smallest of them. Ties at the threshold are taken in layer order."""
+    selected = [score > threshold for score in scores]
+    missing = count - int(torch.stack([select.sum() for select in selected]).sum().item())
+    for score, select in zip(scores, selected):
+        if missing <= 0: break
+        ties = (score == threshold).view(-1).nonzero().view(-1)[:missing]
+        select.view(-1)[ties] = True
+        missing -= ties.numel()
+    return selected
+
+
+def global_kth_smallest(scores, k, max_numel=2**26, num_bins=4096):
+    """The k-th smallest (1-based) entry of all score tensors together.
+
+    Up to `max_numel` entries, the scores are concatenated into one buffer and
+    selected with kthvalue. Above that, the value range is narrowed down with
+    histograms over all layers instead, until the bin holding the k-th entry has at
+    most `max_numel` entries, which are then selected exactly. Only the counts of
+    the bins are read back, once per round.
+    """
+    total = sum(score.numel() for score in scores)
+    if total <= max_numel:
+        return torch.cat([score.reshape(-1) for score in scores]).kthvalue(k)[0]
+
+    lo = min(torch.stack([score.min() for score in scores]).tolist())
+    hi = max(torch.stack([score.max() for score in scores]).tolist())
+    # bins are [edge_i, edge_i+1), the last one also holds hi
+    closed = True
+    while True:
+        if lo >= hi:
+            return torch.tensor(lo, device=scores[0].device)
+        edges = torch.linspace(lo, hi, num_bins + 1, device=scores[0].device, dtype=scores[0].dtype)
+        counts = torch.zeros(num_bins + 1, dtype=torch.long, device=scores[0].device)
+        below = torch.zeros((), dtype=torch.long, device=scores[0].device)
+        for score in scores:
+            inside = score[(score >= lo) & ((score <= hi) if closed else (score < hi))]
+            # bucketize(right=True) - 1 is the bin of each entry, entries equal to hi go to the last bin
+            bins = (torch.bucketize(inside, edges, right=True) - 1).clamp_(0, num_bins - 1)
+            counts += torch.bincount(bins, minlength=num_bins + 1)
+            below += (score < lo).sum()
+        counts = counts[:num_bins].tolist()
+        below = int(below.item())
+
+        cumulative = below
+        for b, count in enumerate(counts):
+            if cumulative + count >= k:
+                break
+            cumulative += count
+        new_lo, new_hi = edges[b].item(), edges[b + 1].item()
+        closed = closed and b == num_bins - 1
+        if counts[b] <= max_numel or (new_lo, new_hi) == (lo, hi):
+            candidates = torch.cat([score[(score >= new_lo) & ((score <= new_hi) if closed else (score < new_hi))]
+                                    for score in scores])
+            return candidates.kthvalue(k - cumulative)[0]
+        lo, hi = new_lo, new_hi
 
 
 def magnitude_and_negativity_prune(masking, mask, weight, name):
@@ -154,12 +309,10 @@ def magnitude_and_negativity_prune(masking, mask, weight, name):
     k = math.ceil(num_zeros + (num_remove/2.0))
 
     # remove all weights which absolute value is smaller than threshold
-    x, idx = torch.sort(torch.abs(weight.data.view(-1)))
-    mask.data.view(-1)[idx[:k]] = 0.0
+    mask.data.view(-1)[topk_indices(torch.abs(weight.data), k, largest=False)] = 0.0
 
     # remove the most negative weights
-    x, idx = torch.sort(weight.data.view(-1))
-    mask.data.view(-1)[idx[:math.ceil(num_remove/2.0)]] = 0.0
+    mask.data.view(-1)[topk_indices(weight.data, math.ceil(num_remove/2.0), largest=False)] = 0.0
 
     return mask
 
@@ -168,29 +321,20 @@ def magnitude_and_negativity_prune(masking, mask, weight, name):
 '''
 
 def random_growth(masking, name, new_mask, total_regrowth, weight):
-    n = (new_mask==0).sum().item()
-    if n == 0: return new_mask
+    # the probability stays on the device, a layer without inactive weights has nothing to grow anyway
+    n = (new_mask==0).sum().clamp(min=1)
     expeced_growth_probability = (total_regrowth/n)
-    new_weights = torch.rand(new_mask.shape).cuda() < expeced_growth_probability
+    new_weights = torch.rand(new_mask.shape, device=new_mask.device) < expeced_growth_probability
     return new_mask.bool() | new_weights
 
 def random_unfired_growth(masking, name, new_mask, total_regrowth, weight):
-    n = (new_mask == 0).sum().item()
-    if n == 0: return new_mask
-    num_nonfired_weights = (masking.fired_masks[name] == 0).sum().item()
-
-    if total_regrowth <= num_nonfired_weights:
-        idx = (masking.fired_masks[name].flatten() == 0).nonzero()
-        indices = torch.randperm(len(idx))[:total_regrowth]
-
-        # idx = torch.nonzero(self.fired_masks[name].flatten())
-        new_mask.data.view(-1)[idx[indices]] = 1.0
-    else:
-        new_mask[masking.fired_masks[name] == 0] = 1.0
-        n = (new_mask == 0).sum().item()
-        expeced_growth_probability = ((total_regrowth - num_nonfired_weights) / n)
-        new_weights = torch.rand(new_mask.shape).cuda() < expeced_growth_probability
-        new_mask = new_mask.byte() | new_weights
+    """Grows weights at random, weights that have never been active in the group first."""
+    fired = masking.get_fired_mask(name).to(new_mask.device)
+    # unfired weights score above every fired inactive one, active weights are never selected
+    scores = torch.rand(new_mask.shape, device=new_mask.device) + (~fired).float()
+    scores = torch.where(new_mask.bool(), torch.full_like(scores, -1.0), scores)
+    new_mask = new_mask.bool()
+    new_mask.view(-1)[topk_indices(scores, total_regrowth)] = True
     return new_mask
 
 def gradient_growth(masking, name, new_mask, total_regrowth, weight):
@@ -203,24 +347,33 @@ def gradient_growth(masking, name, new_mask, total_regrowth, weight):
     # new_mask.data.view(-1)[idx[:total_regrowth]] = 1.0
 
     grad = masking.get_gradient_for_weights(weight)
+    new_mask = new_mask.to(grad.device)
 
-    # operate on zero mask ind
+    # grow back in the zero mask ind, with the largest gradients. Regrowth beyond the
+    # inactive weights selects active ones, which leaves them active
+    new_mask.data.reshape(-1)[topk_indices(growth_scores(new_mask, grad), total_regrowth)] = 1.0
 
-    all_ind = torch.arange(grad.numel(), device=grad.device).view(grad.shape)
-    all_ind = all_ind.to(grad.device)
-    new_mask = new_mask.to(grad.device)
+    return new_mask
 
-    select_ind = all_ind[new_mask == 0]
 
-    # sort the gradients
+def growth_scores(new_mask, grad):
+    # active weights score below every inactive one, so they are never grown again
+    return torch.where(new_mask == 0, torch.abs(grad), torch.full_like(grad, -1.0))
 
-    y, idx = torch.sort(torch.abs(grad[new_mask == 0]), descending=True)
 
-    # grow back in the zeo mask ind
+def batched_topk_growth(new_masks, total_regrowths, grads):
+    grown = batched_topk_masks([growth_scores(mask, grad) for mask, grad in zip(new_masks, grads)], total_regrowths)
+    return [mask.bool() | grow for mask, grow in zip(new_masks, grown)]
 
-    new_mask.data.reshape(-1)[select_ind[idx[:total_regrowth]]] = 1.0
 
-    return new_mask
+def batched_gradient_growth(masking, names, new_masks, total_regrowths, weights):
+    """`gradient_growth` of several layers at once, see `batched_topk_masks`."""
+    return batched_topk_growth(new_masks, total_regrowths, [masking.get_gradient_for_weights(weight) for weight in weights])
+
+
+def batched_momentum_growth(masking, names, new_masks, total_regrowths, weights):
+    """`momentum_growth` of several layers at once, see `batched_topk_masks`."""
+    return batched_topk_growth(new_masks, total_regrowths, [masking.get_momentum_for_weight(weight) for weight in weights])
 
 def mix_growth(masking, name, new_mask, total_regrowth, weight):
     gradient_grow = int(total_regrowth * masking.mix)
@@ -231,12 +384,11 @@ def mix_growth(masking, name, new_mask, total_regrowth, weight):
         grad = grad * (new_mask == 0).half()
     else:
         grad = grad * (new_mask == 0).float()
-    y, idx = torch.sort(torch.abs(grad).flatten(), descending=True)
-    new_mask.data.view(-1)[idx[:gradient_grow]] = 1.0
+    new_mask.data.view(-1)[topk_indices(torch.abs(grad), gradient_grow)] = 1.0
 
-    n = (new_mask == 0).sum().item()
+    n = (new_mask == 0).sum().clamp(min=1)
     expeced_growth_probability = (random_grow / n)
-    new_weights = torch.rand(new_mask.shape).cuda() < expeced_growth_probability
+    new_weights = torch.rand(new_mask.shape, device=new_mask.device) < expeced_growth_probability
     new_mask = new_mask.bool() | new_weights
 
     return new_mask
@@ -311,8 +463,7 @@ def momentum_growth(masking, name, new_mask, total_regrowth, weight):
         grad = grad*(new_mask==0).half()
     else:
         grad = grad*(new_mask==0).float()
-    y, idx = torch.sort(torch.abs(grad).flatten(), descending=True)
-    new_mask.data.view(-1)[idx[:total_regrowth]] = 1.0
+    new_mask.data.view(-1)[topk_indices(torch.abs(grad), total_regrowth)] = 1.0
 
     return new_mask
 
@@ -329,62 +480,36 @@ def momentum_neuron_growth(masking, name, new_mask, total_regrowth, weight):
     slots_per_neuron = (new_mask==0).sum(sum_dim)
 
     M = M*(new_mask==0).float()
-    for i, fraction  in enumerate(v):
-        neuron_regrowth = math.floor(fraction.item()*total_regrowth)
-        available = slots_per_neuron[i].item()
-
-        y, idx = torch.sort(M[i].flatten())
-        if neuron_regrowth > available:
-            neuron_regrowth = available
-        # TODO: Work into more stable growth method
-        threshold = y[-(neuron_regrowth)].item()
-        if threshold == 0.0: continue
-        if neuron_regrowth < 10: continue
-        new_mask[i] = new_mask[i] | (M[i] > threshold)
+    neuron_regrowth = torch.min(torch.floor(v*total_regrowth).long(), slots_per_neuron.long())
+    # the threshold of every neuron is its neuron_regrowth-th largest value, taken from one batched topk
+    k_max = max(int(neuron_regrowth.max().item()), 1)
+    top = torch.topk(M.flatten(1), k_max, dim=1)[0]
+    threshold = top.gather(1, (neuron_regrowth.clamp(min=1) - 1).unsqueeze(1)).squeeze(1)
+    # TODO: Work into more stable growth method
+    grow = (threshold != 0.0) & (neuron_regrowth >= 10)
+    threshold = threshold.view(-1, *([1] * (M.dim() - 1)))
+    new_mask = new_mask | ((M > threshold) & grow.view_as(threshold))
 
     return new_mask
 
 
 def global_momentum_growth(masking, total_regrowth):
-    togrow = total_regrowth
-    total_grown = 0
-    last_grown = 0
-    while total_grown < togrow*(1.0-masking.tolerance) or (total_grown > togrow*(1.0+masking.tolerance)):
-        total_grown = 0
-        total_possible = 0
-        for module in masking.modules:
-            for name, weight in module.named_parameters():
-                if name not in masking.masks: continue
-
-                new_mask = masking.masks[name]
-                grad = masking.get_momentum_for_weight(weight)
-                grad = grad*(new_mask==0).float()
-                possible = (grad !=0.0).sum().item()
-                total_possible += possible
-                grown = (torch.abs(grad.data) > masking.growth_threshold).sum().item()
-                total_grown += grown
-        if total_grown == last_grown: break
-        last_grown = total_grown
-
-
-        if total_grown > togrow*(1.0+masking.tolerance):
-            masking.growth_threshold *= 1.02
-            #masking.growth_increment *= 0.95
-        elif total_grown < togrow*(1.0-masking.tolerance):
-            masking.growth_threshold *= 0.98
-            #masking.growth_increment *= 0.95
-
-    total_new_nonzeros = 0
-    for module in masking.modules:
-        for name, weight in module.named_parameters():
-            if name not in masking.masks: continue
+    """Grows the `total_regrowth` inactive weights with the largest momentum over all layers.
 
-            new_mask = masking.masks[name]
-            grad = masking.get_momentum_for_weight(weight)
-            grad = grad*(new_mask==0).float()
-            masking.masks[name][:] = (new_mask.bool() | (torch.abs(grad.data) > masking.growth_threshold)).float()
-            total_new_nonzeros += new_mask.sum().item()
-    return total_new_nonzeros
+    Like `global_magnitude_prune`, the threshold is the exact global order statistic
+    of the scores of all layers. Returns the number of nonzeros after growth.
+    """
+    names, weights = masked_weights(masking)
+    masks = [masking.masks[name] for name in names]
+    if total_regrowth > 0:
+        scores = [growth_scores(mask, masking.get_momentum_for_weight(weight)) for mask, weight in zip(masks, weights)]
+        total = sum(mask.numel() for mask in masks)
+        # everything above the (total - total_regrowth)-th smallest score is grown
+        k = max(total - int(total_regrowth), 1)
+        threshold = global_kth_smallest(scores, k, masking.max_selection_numel)
+        for mask, grow in zip(masks, largest_masks(scores, threshold, total - k)):
+            mask[:] = mask.bool() | grow
+    return int(torch.stack([mask.sum() for mask in masks]).sum().item())
 
 
 
@@ -403,6 +528,14 @@ growth_funcs['mix'] = mix_growth
 growth_funcs['momentum_neuron'] = momentum_neuron_growth
 growth_funcs['global_momentum_growth'] = global_momentum_growth
 
+# layer-batched versions, used by Masking.truncate_weights when both the prune and the growth function have one
+batched_prune_funcs = {}
+batched_prune_funcs[magnitude_prune] = batched_magnitude_prune
+
+batched_growth_funcs = {}
+batched_growth_funcs[gradient_growth] = batched_gradient_growth
+batched_growth_funcs[momentum_growth] = batched_momentum_growth
+
 redistribution_funcs = {}
 redistribution_funcs['momentum'] = momentum_redistribution
 redistribution_funcs['nonzero'] = nonzero_redistribution
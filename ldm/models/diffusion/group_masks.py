@@ -0,0 +1,117 @@
+"""
+Group mask handling shared by the LatentDiffusion models trained with a Masking: serving
+the group masks while sampling and keeping the modified masks in the checkpoints.
+"""
+
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from ldm.models.diffusion.sparse_inference import export_sparse_group
+
+
+class GroupMasksMixin(object):
+    """Expects `self.sparse`, the Masking `self.mask` if sparse, `self.mask_plan` and
+    `timestep_to_mask_index`.
+
+    Checkpoints hold the layer densities and the packed masks of the groups that were
+    modified, see `Masking.modified_group_state`. All other groups are generated again on
+    resume, so the size of a checkpoint grows with the modified groups only, and no
+    group is generated to save it. With `self.mask_plan` set, the masks of all groups
+    are also written to that mask plan once, at the first checkpoint.
+    """
+
+    # (dense UNet, min_sparsity, max_sparse_groups, exported UNets of the recent groups) while
+    # sampling with sparse kernels
+    sparse_kernel_state = None
+
+    @contextmanager
+    def mask_scope(self, context=None, sparse_kernels=False, min_sparsity=0.5, max_sparse_groups=2):
+        """Serves the group masks while sampling: the dense weights are kept aside once and
+        `activate_mask_for_timestep` applies the mask of a group only when sampling enters it.
+
+        With `sparse_kernels`, the UNet of a group is instead exported with
+        `export_sparse_group` when sampling enters the group, and swapped in for
+        `self.model`, so that its pruned layers run with sparse kernels on CPU. The samplers
+        visit every group once, so only the `max_sparse_groups` most recently used exports
+        are kept. Every export copies the UNet, so sparse kernels pay off for groups that
+        span many sampling steps.
+        """
+        if self.sparse and sparse_kernels:
+            with self.sparse_kernel_scope(context, min_sparsity, max_sparse_groups):
+                yield None
+            return
+        if self.sparse:
+            self.mask.store_weights()
+            if context is not None:
+                print(f"{context}: Switched to group masks")
+        try:
+            yield None
+        finally:
+            if self.sparse:
+                self.mask.restore_weights()
+                if context is not None:
+                    print(f"{context}: Restored dense weights")
+
+    @contextmanager
+    def sparse_kernel_scope(self, context=None, min_sparsity=0.5, max_sparse_groups=2):
+        if self.device.type != 'cpu':
+            raise ValueError(f"Sparse kernels run on CPU, got a model on {self.device}")
+        dense_model = self.model
+        self.sparse_kernel_state = (dense_model, min_sparsity, max(max_sparse_groups, 1), OrderedDict())
+        if context is not None:
+            print(f"{context}: Switched to sparse group kernels")
+        try:
+            yield None
+        finally:
+            self.model = dense_model
+            self.sparse_kernel_state = None
+            if context is not None:
+                print(f"{context}: Restored dense model")
+
+    def activate_mask_for_timestep(self, t):
+        if not self.sparse:
+            return
+        mask_index = self.timestep_to_mask_index(t)
+        if self.sparse_kernel_state is None:
+            self.mask.activate_mask(mask_index)
+            return
+        dense_model, min_sparsity, max_sparse_groups, exported = self.sparse_kernel_state
+        if mask_index in exported:
+            exported.move_to_end(mask_index)
+        else:
+            while len(exported) >= max_sparse_groups:
+                exported.popitem(last=False)
+            # the model of the previous group is still referenced until it is swapped out below
+            exported[mask_index] = export_sparse_group(dense_model, self.mask, mask_index, min_sparsity=min_sparsity)
+        self.model = exported[mask_index]
+
+    def on_save_checkpoint(self, checkpoint):
+        if not self.sparse:
+            return
+        checkpoint['mask_generator'] = self.mask.generator_signature()
+        if not self.mask.layer_wise_sparsity:
+            # the masks are not initialized yet
+            return
+        checkpoint['mask_groups'] = self.mask.modified_group_state()
+        if self.mask_plan is not None and not os.path.exists(self.mask_plan + '.json') and self.trainer.is_global_zero:
+            # the plan of all groups is only written if asked for, once
+            self.mask.save_mask_plan(self.mask_plan)
+
+    def on_load_checkpoint(self, checkpoint):
+        if not self.sparse:
+            return
+        # masks that are not stored are generated again, by the generator they were trained with
+        self.mask.check_generator(checkpoint.get('mask_generator'), 'the checkpoint')
+        state = checkpoint.get('mask_groups')
+        if state is not None:
+            self.mask.load_modified_group_state(state, 'The checkpoint')
+            return
+        # checkpoints that refer to a mask plan of all groups instead
+        path = checkpoint.get('mask_plan')
+        if path is None:
+            return
+        if not os.path.exists(path + '.json'):
+            raise FileNotFoundError(f"Mask plan {path} of the checkpoint not found, the masks of its groups may have "
+                                    f"been modified and can not be generated again")
+        self.mask.load_mask_plan(path, plan_id=checkpoint.get('mask_plan_id'))
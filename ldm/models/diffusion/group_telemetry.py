@@ -0,0 +1,130 @@
+"""
+Per-group training statistics of LatentDiffusion, accumulated on the device and read back
+once per flush.
+"""
+
+import bisect
+import math
+import time
+import torch
+import torch.distributed as dist
+
+
+# rows of GroupTelemetry.stats
+SAMPLES, LOSS_SIMPLE, LOSS_VLB, STEPS, STEP_TIME, SWITCHES, SWITCH_TIME = range(7)
+
+
+class GroupTelemetry(object):
+    """Accumulates step times, mask switch times, losses and sample counts per group.
+
+    Group i covers the timesteps from boundaries[i] up to boundaries[i + 1]. Losses and
+    counts are summed into a device tensor. On CUDA the times are taken with events that
+    are only read in `flush`, so no step waits for the device. The time of a step is split
+    between its groups in proportion to their samples. `flush` sums the statistics of all
+    ranks, returns the means over the window since the last flush and starts a new one.
+    """
+    def __init__(self, boundaries):
+        self.boundaries = list(boundaries)
+        self.num_groups = len(self.boundaries) - 1
+        self.device = None
+        self.stats = None
+        self.step_start = None
+        self.step_samples = None
+        # (start, end, samples per group) of the steps and (group, start, end) of the switches
+        self.pending_steps = []
+        self.pending_switches = []
+
+    def groups(self, t):
+        return torch.bucketize(t, torch.tensor(self.boundaries[1:-1], device=t.device), right=True)
+
+    def group_of(self, t):
+        return min(bisect.bisect_right(self.boundaries, int(t)) - 1, self.num_groups - 1)
+
+    def timer(self):
+        if self.device is not None and self.device.type == 'cuda':
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    @staticmethod
+    def elapsed(start, end):
+        """Seconds between two `timer` readings."""
+        if isinstance(start, float):
+            return end - start
+        return start.elapsed_time(end) / 1000.
+
+    def start_step(self, device):
+        device = torch.device(device)
+        if self.stats is None or self.stats.device != device:
+            self.device = device
+            self.stats = torch.zeros(7, self.num_groups, device=device)
+        self.step_samples = torch.zeros(self.num_groups, device=device)
+        self.step_start = self.timer()
+
+    def add_switch(self, mask_index, start):
+        """Records a mask switch to group `mask_index` that started at the `timer` reading `start`."""
+        if self.step_start is not None:
+            self.pending_switches.append((int(mask_index), start, self.timer()))
+
+    def add_samples(self, t, loss_simple, loss_vlb):
+        """Adds the per-sample losses of the timesteps `t`."""
+        if self.step_start is None:
+            return
+        groups = self.groups(t)
+        ones = torch.ones_like(loss_simple, dtype=self.stats.dtype)
+        self.step_samples.index_add_(0, groups, ones)
+        self.stats[SAMPLES].index_add_(0, groups, ones)
+        self.stats[LOSS_SIMPLE].index_add_(0, groups, loss_simple.detach().to(self.stats.dtype))
+        self.stats[LOSS_VLB].index_add_(0, groups, loss_vlb.detach().to(self.stats.dtype))
+
+    def end_step(self):
+        if self.step_start is None:
+            return
+        self.pending_steps.append((self.step_start, self.timer(), self.step_samples))
+        self.step_start = None
+        self.step_samples = None
+
+    def flush(self, densities=None):
+        """Returns the statistics since the last flush, keyed by metric name.
+
+        Losses and times are means per sample, step and switch of every group, groups
+        without samples in the window only report their counts. `densities`, a tensor of
+        the mask density of every group, NaN if unknown, is logged as it is.
+        """
+        if self.stats is None:
+            return {}
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        stats = self.stats
+        if self.pending_steps:
+            times = torch.tensor([self.elapsed(start, end) for start, end, _ in self.pending_steps], device=self.device)
+            samples = torch.stack([samples for _, _, samples in self.pending_steps])
+            shares = samples / samples.sum(dim=1, keepdim=True).clamp(min=1)
+            stats[STEPS] += (samples > 0).sum(dim=0)
+            stats[STEP_TIME] += times @ shares
+        for mask_index, start, end in self.pending_switches:
+            stats[SWITCHES, mask_index] += 1
+            stats[SWITCH_TIME, mask_index] += self.elapsed(start, end)
+        self.pending_steps, self.pending_switches = [], []
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(stats)
+        rows = stats.tolist()
+        densities = densities.tolist() if densities is not None else None
+        stats.zero_()
+
+        metrics = {}
+        for group in range(self.num_groups):
+            prefix = f'groups/{group}/'
+            samples, steps, switches = rows[SAMPLES][group], rows[STEPS][group], rows[SWITCHES][group]
+            metrics[prefix + 'samples'] = samples
+            if samples > 0:
+                metrics[prefix + 'loss_simple'] = rows[LOSS_SIMPLE][group] / samples
+                metrics[prefix + 'loss_vlb'] = rows[LOSS_VLB][group] / samples
+            if steps > 0:
+                metrics[prefix + 'step_time'] = rows[STEP_TIME][group] / steps
+            if switches > 0:
+                metrics[prefix + 'switch_time'] = rows[SWITCH_TIME][group] / switches
+            if densities is not None and not math.isnan(densities[group]):
+                metrics[prefix + 'density'] = densities[group]
+        return metrics
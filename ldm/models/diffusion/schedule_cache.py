@@ -0,0 +1,78 @@
+"""SAMPLING ONLY.
+
+DDIM schedules shared by the DDIM and PLMS samplers.
+"""
+
+import weakref
+import numpy as np
+import torch
+from collections import OrderedDict
+
+from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps
+
+
+def make_ddim_schedule(model, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
+    """The DDIM schedule of `model` as a dict of sampler attributes, tensors on the device of the model."""
+    device = model.device
+    ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
+                                         num_ddpm_timesteps=model.num_timesteps, verbose=verbose)
+    alphas_cumprod = model.alphas_cumprod
+    assert alphas_cumprod.shape[0] == model.num_timesteps, 'alphas have to be defined for each timestep'
+    to_torch = lambda x: x.clone().detach().to(torch.float32).to(device)
+
+    schedule = {'ddim_timesteps': ddim_timesteps}
+    schedule['betas'] = to_torch(model.betas)
+    schedule['alphas_cumprod'] = to_torch(alphas_cumprod)
+    schedule['alphas_cumprod_prev'] = to_torch(model.alphas_cumprod_prev)
+
+    # calculations for diffusion q(x_t | x_{t-1}) and others
+    schedule['sqrt_alphas_cumprod'] = schedule['alphas_cumprod'].sqrt()
+    schedule['sqrt_one_minus_alphas_cumprod'] = (1. - schedule['alphas_cumprod']).sqrt()
+    schedule['log_one_minus_alphas_cumprod'] = (1. - schedule['alphas_cumprod']).log()
+    schedule['sqrt_recip_alphas_cumprod'] = schedule['alphas_cumprod'].rsqrt()
+    schedule['sqrt_recipm1_alphas_cumprod'] = (1. / schedule['alphas_cumprod'] - 1).sqrt()
+
+    # ddim sampling parameters
+    ddim_sigmas, ddim_alphas, ddim_alphas_prev = make_ddim_sampling_parameters(alphacums=alphas_cumprod.cpu(),
+                                                                               ddim_timesteps=ddim_timesteps,
+                                                                               eta=ddim_eta, verbose=verbose)
+    schedule['ddim_sigmas'] = ddim_sigmas
+    schedule['ddim_alphas'] = ddim_alphas
+    schedule['ddim_alphas_prev'] = ddim_alphas_prev
+    schedule['ddim_sqrt_one_minus_alphas'] = np.sqrt(1. - ddim_alphas)
+    alphas_cumprod, alphas_cumprod_prev = schedule['alphas_cumprod'], schedule['alphas_cumprod_prev']
+    schedule['ddim_sigmas_for_original_num_steps'] = ddim_eta * torch.sqrt(
+        (1 - alphas_cumprod_prev) / (1 - alphas_cumprod) * (1 - alphas_cumprod / alphas_cumprod_prev))
+    return {name: value.to(device) if isinstance(value, torch.Tensor) else value for name, value in schedule.items()}
+
+
+class ScheduleCache(object):
+    """Keeps the most recently used DDIM schedules of every model, see `make_ddim_schedule`.
+
+    Schedules are keyed by the device and diffusion schedule of the model and by the
+    number of steps, eta and discretization, so repeated `sample` calls with the same
+    parameters reuse the tensors already on the device. At most `max_size` schedules are
+    kept per model, and they are dropped together with the model.
+    """
+    def __init__(self, max_size=8):
+        self.max_size = max_size
+        self.schedules = weakref.WeakKeyDictionary()
+
+    def get(self, model, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
+        # the data pointer changes when the model registers a new diffusion schedule
+        key = (str(model.device), model.alphas_cumprod.data_ptr(), int(ddim_num_steps), ddim_discretize, float(ddim_eta))
+        schedules = self.schedules.setdefault(model, OrderedDict())
+        if key in schedules:
+            schedules.move_to_end(key)
+            return schedules[key]
+        schedule = make_ddim_schedule(model, ddim_num_steps, ddim_discretize, ddim_eta, verbose)
+        schedules[key] = schedule
+        while len(schedules) > self.max_size:
+            schedules.popitem(last=False)
+        return schedule
+
+    def clear(self):
+        self.schedules = weakref.WeakKeyDictionary()
+
+
+schedule_cache = ScheduleCache()
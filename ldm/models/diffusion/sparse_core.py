@@ -4,8 +4,16 @@ import torch.nn as nn
 import torch.optim as optim
 import numpy as np
 import math
-from .funcs import redistribution_funcs, growth_funcs, prune_funcs
+import os
+import json
+import zlib
+import hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from .funcs import redistribution_funcs, growth_funcs, prune_funcs, batched_growth_funcs, batched_prune_funcs
 import copy
+from ldm.modules.diffusionmodules.util import register_checkpoint_context
 
 def get_model_params(model):
     params = {}
@@ -18,6 +26,135 @@ def set_model_params(model, model_parameters):
     model.load_state_dict(model_parameters)
 
 
+_bit_weights = {}
+_popcounts = {}
+
+def get_bit_weights(device):
+    device = torch.device(device)
+    if device not in _bit_weights:
+        _bit_weights[device] = torch.tensor([1, 2, 4, 8, 16, 32, 64, 128], dtype=torch.uint8, device=device)
+    return _bit_weights[device]
+
+
+def pack_mask(mask):
+    """Packs a binary mask into a flat uint8 tensor holding 8 mask entries per byte."""
+    flat = mask.reshape(-1).to(torch.uint8)
+    pad = (-flat.numel()) % 8
+    if pad:
+        flat = torch.cat([flat, flat.new_zeros(pad)])
+    return (flat.view(-1, 8) * get_bit_weights(flat.device)).sum(dim=-1, dtype=torch.uint8)
+
+
+def move_packed(packed, device):
+    """Moves the packed masks `packed`, keyed by layer name, to `device` in one transfer of
+    their concatenation. The moved masks are views of the concatenated buffer."""
+    names = list(packed)
+    if not names:
+        return {}
+    flat = torch.cat([packed[name] for name in names]).to(device)
+    return dict(zip(names, flat.split([packed[name].numel() for name in names])))
+
+
+def packed_digest(packed):
+    """Hex digest of the packed masks `packed`, keyed by layer name. The masks of all layers
+    are read back from the device at once."""
+    names = sorted(packed)
+    digest = hashlib.sha1()
+    for name in names:
+        digest.update(f'{name}:{packed[name].numel()};'.encode())
+    if names:
+        digest.update(torch.cat([packed[name] for name in names]).cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def popcount(packed):
+    """Number of set bits of a packed mask, as a device tensor."""
+    device = packed.device
+    if device not in _popcounts:
+        _popcounts[device] = torch.tensor([bin(i).count('1') for i in range(256)], dtype=torch.uint8, device=device)
+    return _popcounts[device][packed.long()].sum()
+
+
+def unpack_mask(packed, shape):
+    """Inverse of `pack_mask`, returns a bool mask of the given shape."""
+    numel = int(np.prod(shape))
+    bits = packed.unsqueeze(-1).bitwise_and(get_bit_weights(packed.device)).ne(0)
+    return bits.view(-1)[:numel].view(shape)
+
+
+def broadcast_masks(masks, src=0, bucket_bytes=2**24):
+    """Broadcasts the masks, a dict of bool tensors, from rank `src` and unpacks them in place.
+
+    The masks are bit-packed and concatenated into buckets of about `bucket_bytes`,
+    so all layers travel in a few collectives at 1/8 of their bool size.
+    Returns the number of broadcasts.
+    """
+    names = list(masks)
+    packed = [pack_mask(masks[name]) for name in names]
+    buckets = []
+    bucket, size = [], 0
+    for i, p in enumerate(packed):
+        bucket.append(i)
+        size += p.numel()
+        if size >= bucket_bytes:
+            buckets.append(bucket)
+            bucket, size = [], 0
+    if bucket:
+        buckets.append(bucket)
+
+    for bucket in buckets:
+        flat = torch.cat([packed[i] for i in bucket])
+        torch.distributed.broadcast(flat, src=src)
+        for i, chunk in zip(bucket, flat.split([packed[i].numel() for i in bucket])):
+            mask = masks[names[i]]
+            mask.copy_(unpack_mask(chunk, mask.shape))
+    return len(buckets)
+
+
+# layers in the flat buffers start at multiples of this many elements
+FLAT_CHUNK = 1024
+
+
+MASK_32 = 0xFFFFFFFF
+
+
+def hash32(x):
+    """lowbias32 integer hash of the low 32 bits of `x`, an int or an int64 tensor.
+
+    Only integer arithmetic is used, so tensors hash bit-identically on every device.
+    Products may wrap around in int64, which leaves their low 32 bits intact.
+    """
+    x = x & MASK_32
+    x = x ^ (x >> 16)
+    x = (x * 0x7feb352d) & MASK_32
+    x = x ^ (x >> 15)
+    x = (x * 0x846ca68b) & MASK_32
+    return x ^ (x >> 16)
+
+
+def hash_key(seed, group, name):
+    """Key of the counter-based masks of layer `name` in group `group`."""
+    return hash32(hash32(hash32(seed) ^ group) ^ zlib.crc32(name.encode()))
+
+
+def hash_scores(key, start, count, device):
+    """Uniform 32-bit scores of the elements start, ..., start + count - 1 of a layer with key `key`."""
+    counter = torch.arange(start, start + count, dtype=torch.long, device=device)
+    return hash32(hash32(counter * 0x9e3779b9 + (key & 0xFFFF)) ^ key)
+
+
+def hash_mask(key, shape, density, device, tile_size=2**20):
+    """Bool mask keeping each element with probability `density`, generated tile by tile,
+    so the int64 scores of at most `tile_size` elements exist at any time."""
+    mask = torch.empty(shape, dtype=torch.bool, device=device)
+    flat = mask.view(-1)
+    threshold = min(max(int(round(density * 2**32)), 0), 2**32)
+    for start in range(0, flat.numel(), tile_size):
+        count = min(tile_size, flat.numel() - start)
+        flat[start:start + count] = hash_scores(key, start, count, device) < threshold
+    return mask
+
+
 class CosineDecay(object):
     """Decays a pruning rate according to a cosine schedule
 
@@ -50,20 +187,22 @@ class LinearDecay(object):
     def get_dr(self, prune_rate):
         return self.current_prune_rate
 
-def prefetched_loader(loader, fp16):
-    mean = torch.tensor([0.485 * 255, 0.456 * 255, 0.406 * 255]).cuda().view(1, 3, 1, 1)
-    std = torch.tensor([0.229 * 255, 0.224 * 255, 0.225 * 255]).cuda().view(1, 3, 1, 1)
+def prefetched_loader(loader, fp16, device='cuda'):
+    device = torch.device(device)
+    mean = torch.tensor([0.485 * 255, 0.456 * 255, 0.406 * 255], device=device).view(1, 3, 1, 1)
+    std = torch.tensor([0.229 * 255, 0.224 * 255, 0.225 * 255], device=device).view(1, 3, 1, 1)
     if fp16:
         mean = mean.half()
         std = std.half()
 
-    stream = torch.cuda.Stream()
+    # the copies only overlap with compute on a side stream of a CUDA device, elsewhere they are plain copies
+    stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
     first = True
 
     for next_input, next_target in loader:
         with torch.cuda.stream(stream):
-            next_input = next_input.cuda(non_blocking=True)
-            next_target = next_target.cuda(non_blocking=True)
+            next_input = next_input.to(device, non_blocking=True)
+            next_target = next_target.to(device, non_blocking=True)
             if fp16:
                 next_input = next_input.half()
             else:
@@ -75,12 +214,144 @@ def prefetched_loader(loader, fp16):
         else:
             first = False
 
-        torch.cuda.current_stream().wait_stream(stream)
+        if stream is not None:
+            torch.cuda.current_stream(device).wait_stream(stream)
         input = next_input
         target = next_target
 
     yield input, target
 
+class MaskedAdamW(optim.AdamW):
+    """AdamW that only updates the entries selected by the active masks of `masking`.
+
+    Weights, moments and weight decay of inactive entries are left untouched, so the
+    dense weights do not need to be saved and restored around the optimizer step.
+    Parameters without a mask are updated exactly like in AdamW.
+    """
+    def __init__(self, params, masking, **kwargs):
+        super().__init__(params, **kwargs)
+        self.masking = masking
+        for group in self.param_groups:
+            if group['amsgrad']:
+                raise ValueError('{0} does not support amsgrad'.format(self.__class__.__name__))
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                mask = self.masking.get_mask_for_weight(p)
+                if mask is None:
+                    state = self.init_state(self.state[p], p)
+                    self.adamw_update(p, p.grad, state, group)
+                else:
+                    self.masked_update(p, p.grad, mask.to(p.device), group)
+
+        return loss
+
+    def init_state(self, state, p):
+        if len(state) == 0:
+            state['step'] = 0
+            state['exp_avg'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+            state['exp_avg_sq'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+        return state
+
+    def adamw_update(self, p, grad, state, group, mask=None):
+        beta1, beta2 = group['betas']
+        exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+        state['step'] += 1
+        bias_correction1 = 1 - beta1 ** state['step']
+        bias_correction2 = 1 - beta2 ** state['step']
+        step_size = group['lr'] / bias_correction1
+
+        if mask is None:
+            p.mul_(1 - group['lr'] * group['weight_decay'])
+            exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(group['eps'])
+            p.addcdiv_(exp_avg, denom, value=-step_size)
+        else:
+            mask = mask.to(p.dtype)
+            p.addcmul_(p, mask, value=-group['lr'] * group['weight_decay'])
+            exp_avg.addcmul_(grad - exp_avg, mask, value=1 - beta1)
+            exp_avg_sq.addcmul_(grad * grad - exp_avg_sq, mask, value=1 - beta2)
+            denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(group['eps'])
+            p.addcdiv_(exp_avg * mask, denom, value=-step_size)
+
+    def masked_update(self, p, grad, mask, group):
+        state = self.init_state(self.state[p], p)
+        self.adamw_update(p, grad, state, group, mask=mask)
+
+
+class GroupSparseAdamW(MaskedAdamW):
+    """MaskedAdamW with separate, compact moments for every group of `masking`.
+
+    For each masked parameter and group only the entries active in the group's mask
+    get moments, stored in the order of the flattened mask. Groups therefore neither
+    share moments nor step counts, and the state of a group costs its density times
+    the dense state. The flat indices of the active entries are kept with the moments,
+    so a step gathers and scatters a known number of entries and never waits for the
+    device. The state of a group is tied to its masks by `Masking.mask_key`. When the
+    masks change (e.g. after `truncate_weights`, or on resuming with other masks) the
+    moments are carried over for entries that stay active and reset for new ones.
+    """
+    def masked_update(self, p, grad, mask, group):
+        param_state = self.state[p]
+        if len(param_state) == 0:
+            param_state['step'] = 0
+            param_state['groups'] = {}
+        param_state['step'] += 1
+        mask_key = self.masking.mask_key(self.masking.mask_index)
+        state = param_state['groups'].setdefault(self.masking.mask_index, {})
+        if len(state) == 0:
+            indices = mask.view(-1).nonzero(as_tuple=True)[0]
+            state['step'] = 0
+            state['exp_avg'] = p.new_zeros(indices.numel())
+            state['exp_avg_sq'] = p.new_zeros(indices.numel())
+            state['indices'] = indices.int()
+            state['mask'] = pack_mask(mask)
+            state['mask_key'] = mask_key
+        elif state.get('mask_key') != mask_key or 'indices' not in state:
+            self.remap_state(state, mask, mask_key)
+
+        indices = state['indices'].long()
+        weight = p.view(-1)[indices]
+        self.adamw_update(weight, grad.reshape(-1)[indices], state, group)
+        p.view(-1)[indices] = weight
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        # Optimizer.load_state_dict casts all state tensors to the dtype of their parameter and
+        # turns strings into the string of a generator, the indices, packed masks and mask keys
+        # are taken over as they were saved
+        saved_ids = [i for group in state_dict['param_groups'] for i in group['params']]
+        params = [p for group in self.param_groups for p in group['params']]
+        for saved_id, p in zip(saved_ids, params):
+            for mask_index, saved in state_dict['state'].get(saved_id, {}).get('groups', {}).items():
+                state = self.state[p]['groups'][mask_index]
+                for key in ['indices', 'mask', 'mask_key']:
+                    if key in saved:
+                        state[key] = saved[key].to(p.device) if torch.is_tensor(saved[key]) else saved[key]
+
+    def remap_state(self, state, mask, mask_key):
+        old_mask = unpack_mask(state['mask'], mask.shape).view(-1)
+        indices = mask.view(-1).nonzero(as_tuple=True)[0]
+        for key in ['exp_avg', 'exp_avg_sq']:
+            dense = state[key].new_zeros(mask.numel())
+            dense.masked_scatter_(old_mask, state[key])
+            state[key] = dense[indices]
+        state['indices'] = indices.int()
+        state['mask'] = pack_mask(mask)
+        state['mask_key'] = mask_key
+        state.pop('mask_version', None)
+
+
 class Masking(object):
     """Wraps PyTorch model parameters with a sparse mask.
 
@@ -105,7 +376,7 @@ class Masking(object):
         mask.remove_type(torch.nn.BatchNorm2d) removes all 2D batch norm layers.
     """
     def __init__(self, optimizer, train_loader, prune_rate_decay, prune_rate=0.5, prune_mode='magnitude', growth_mode='momentum', redistribution_mode='momentum', verbose=False, fp16=False, num_mask=1,**kwargs):
-        growth_modes = ['random', 'momentum', 'momentum_neuron', 'gradient']
+        growth_modes = list(growth_funcs)
         if growth_mode not in growth_modes:
             print('Growth mode: {0} not supported!'.format(growth_mode))
             print('Supported modes are:', str(growth_modes))
@@ -113,9 +384,22 @@ class Masking(object):
         self.num_mask = num_mask
         self.mask_updates = torch.zeros(self.num_mask)
         self.mask_update = 0
-        self.device = 'cuda'
+        # device of the masks and the mask bank, taken from the weights in add_module and
+        # followed when the weights move, see follow_device
+        self.device = kwargs.get('device')
         self.sparse_init = kwargs['sparse_init']
         self.init_density = kwargs['init_density']
+        self.nm_sparsity = kwargs.get('nm_sparsity', (2, 4))
+        # 'torch': masks from seeded torch generators
+        # 'hash': counter-based masks keyed by (group, layer, element), identical on every device
+        self.mask_generator = kwargs.get('mask_generator', 'torch')
+        if self.mask_generator not in ['torch', 'hash']:
+            raise ValueError(f"Unknown mask generator {self.mask_generator}")
+        self.mask_seed = kwargs.get('mask_seed', 0)
+        # device of the torch generator. CPU and CUDA generators draw different masks from the same
+        # seed, so masks are drawn on the training device whatever device the weights are on at init
+        self.generator_device = torch.device(kwargs.get('generator_device') or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.mask_mode = 'ERK'
 
         self.prune_rate_decay = prune_rate_decay
         self.verbose = verbose
@@ -126,9 +410,47 @@ class Masking(object):
 
         self.global_growth = False
         self.global_prune = False
+        # global prune/growth select over concatenated scores up to this many entries, and with histograms above
+        self.max_selection_numel = kwargs.get('max_selection_numel', 2**26)
 
         self.masks = {}
-        self.masks_local = [{}] * 2
+        # bit-packed masks of the groups in use, indexed by mask_index, on the device of the masks and in
+        # least recently used order. Groups are generated, paged in from the mask plan or copied from the
+        # host bank on first use, and the least recently used ones are dropped once the bank holds more
+        # than mask_bank_bytes. self.masks holds the unpacked masks of the active group.
+        self.mask_bank = OrderedDict()
+        self.mask_bank_bytes = kwargs.get('mask_bank_bytes', 2**30)
+        # host copies of the groups whose masks were modified, which cannot be generated again
+        self.host_bank = {}
+        # memory-mapped packed masks of a loaded mask plan, groups are paged into the bank on first use
+        self.mask_plan = None
+        self.mask_plan_layers = {}
+        self.mask_index = None
+        self.masks_modified = False
+        # incremented whenever masks change after initialization
+        self.mask_version = 0
+        # digests identifying the masks of every group used so far, see mask_key
+        self.mask_keys = {}
+        # masks are applied on the fly in the forward pass instead of to the stored weights
+        self.masked_forward = False
+        # if set, the masks used by the masked forward and by MaskedAdamW instead of self.masks,
+        # e.g. to run sub-batches of different groups, see LatentDiffusion.mixed_group_losses
+        self.forward_masks = None
+        self.update_masks = None
+        self.weight2name = {}
+        # all masked weights and their masks as views into one flat buffer each, see flatten
+        self.flat_buffers = kwargs.get('flat_buffers', False)
+        self.flat_weights = None
+        self.flat_mask = None
+        # dense weights kept while group masks are applied in place for sampling
+        self.stored_weights = None
+        self.applied_mask_index = None
+        # indices of the entries that differ between the masks of consecutive bank groups, keyed by
+        # (i, i + 1) and valid for mask_deltas_version. Layers whose delta is larger than
+        # max_delta_fraction of their weights are stored as None and switched in full.
+        self.mask_deltas = {}
+        self.mask_deltas_version = None
+        self.max_delta_fraction = kwargs.get('max_delta_fraction', 1 / 16)
         self.modules = []
         self.names = []
         self.optimizer = optimizer
@@ -139,6 +461,12 @@ class Masking(object):
         self.name2baseline_nonzero = {}
 
         # stats
+        # per-layer densities, removed and fired counts of the last update, see update_metrics
+        self.metrics = {}
+        # packed bitsets of the weights that have been active at some point, per group and layer, on the
+        # host. They are ORed with the masks of a group whenever they change, see update_fired
+        self.track_fired = kwargs.get('track_fired', True)
+        self.fired_bank = {}
         self.layer_wise_sparsity = {}
         self.name2variance = {}
         self.name2zeros = {}
@@ -213,166 +541,491 @@ class Masking(object):
 
         elif mode == 'ERK_local':
             # print('initialize by fixed_ERK')
+            # every group starts from the same mask, the groups then evolve separately, see group_seed
+            self.mask_mode = 'ERK_local'
             if not self.layer_wise_sparsity:
-                total_params = 0
-                self.baseline_nonzero = 0
-                for name, weight in self.masks.items():
-                    total_params += weight.numel()
-                    self.baseline_nonzero += weight.numel() * density
-                is_epsilon_valid = False
-                dense_layers = set()
-                while not is_epsilon_valid:
-                    divisor = 0
-                    rhs = 0
-                    raw_probabilities = {}
-                    for name, mask in self.masks.items():
-                        n_param = np.prod(mask.shape)
-                        n_zeros = n_param * (1 - density)
-                        n_ones = n_param * density
-
-                        if name in dense_layers:
-                            # See `- default_sparsity * (N_3 + N_4)` part of the equation above.
-                            rhs -= n_zeros
-
-                        else:
-                            # Corresponds to `(1 - default_sparsity) * (N_1 + N_2)` part of the
-                            # equation above.
-                            rhs += n_ones
-                            # Erdos-Renyi probability: epsilon * (n_in + n_out / n_in * n_out).
-                            raw_probabilities[name] = (
-                                                              np.sum(mask.shape) / np.prod(mask.shape)
-                                                      ) ** erk_power_scale
-                            # Note that raw_probabilities[mask] * n_param gives the individual
-                            # elements of the divisor.
-                            divisor += raw_probabilities[name] * n_param
-                    # By multipliying individual probabilites with epsilon, we should get the
-                    # number of parameters per layer correctly.
-                    epsilon = rhs / divisor
-                    # If epsilon * raw_probabilities[mask.name] > 1. We set the sparsities of that
-                    # mask to 0., so they become part of dense_layers sets.
-                    max_prob = np.max(list(raw_probabilities.values()))
-                    max_prob_one = max_prob * epsilon
-                    if max_prob_one > 1:
-                        is_epsilon_valid = False
-                        for mask_name, mask_raw_prob in raw_probabilities.items():
-                            if mask_raw_prob == max_prob:
-                                # print(f"Sparsity of var:{mask_name} had to be set to 0.")
-                                dense_layers.add(mask_name)
-                    else:
-                        is_epsilon_valid = True
-
-                # With the valid epsilon, we can set sparsities of the remaning layers.
-                for name, mask in self.masks.items():
-                    n_param = np.prod(mask.shape)
-                    if name in dense_layers:
-                        self.layer_wise_sparsity[name] = 1.0
-                    else:
-                        probability_one = epsilon * raw_probabilities[name]
-                        self.layer_wise_sparsity[name] = probability_one
-                    # print(
-                    #     f"layer: {name}, shape: {mask.shape}, density: {density_dict[name]}"
-                    # )
-
-            total_nonzero = 0.0
-            total_weight = 0.0
-            generator = torch.Generator(device='cuda')
-            generator.manual_seed(0)
-            # With the valid epsilon, we can set sparsities of the remaning layers.
-            for name, mask in self.masks.items():
-                self.masks_local[0][name] = torch.rand(mask.shape, generator=generator, device='cuda') < self.layer_wise_sparsity[name]
-                total_nonzero += self.layer_wise_sparsity[name] * mask.numel()
-                total_weight += mask.numel()
-            print(f"Overall sparsity {total_nonzero / total_weight}")
-
-
-            total_nonzero = 0.0
-            total_weight = 0.0
-            generator = torch.Generator(device='cuda')
-            generator.manual_seed(0)
-            # With the valid epsilon, we can set sparsities of the remaning layers.
-            for name, mask in self.masks.items():
-                self.masks_local[1][name] = torch.rand(mask.shape, generator=generator, device='cuda') < self.layer_wise_sparsity[name]
-                total_nonzero += self.layer_wise_sparsity[name] * mask.numel()
-                total_weight += mask.numel()
-            print(f"Overall sparsity {total_nonzero / total_weight}")
+                self.compute_erk_densities(density, erk_power_scale)
+                self.print_overall_density()
+            self.load_masks(0)
 
-            self.masks = self.masks_local[0]
-
-        elif mode == 'ERK':
+        elif mode in ['ERK', 'ERK_channel', 'NM']:
             # print('initialize by fixed_ERK')
+            # ERK: unstructured masks with ERK layer densities
+            # ERK_channel: whole output channels, as many per layer as its ERK density allows
+            # NM: N of every M consecutive weights along the input channel, e.g. 2:4
+            self.mask_mode = mode
             if not self.layer_wise_sparsity:
-                total_params = 0
-                self.baseline_nonzero = 0
-                for name, weight in self.masks.items():
-                    total_params += weight.numel()
-                    self.baseline_nonzero += weight.numel() * density
-                is_epsilon_valid = False
-                dense_layers = set()
-                while not is_epsilon_valid:
-                    divisor = 0
-                    rhs = 0
-                    raw_probabilities = {}
-                    for name, mask in self.masks.items():
-                        n_param = np.prod(mask.shape)
-                        n_zeros = n_param * (1 - density)
-                        n_ones = n_param * density
-
-                        if name in dense_layers:
-                            # See `- default_sparsity * (N_3 + N_4)` part of the equation above.
-                            rhs -= n_zeros
-
-                        else:
-                            # Corresponds to `(1 - default_sparsity) * (N_1 + N_2)` part of the
-                            # equation above.
-                            rhs += n_ones
-                            # Erdos-Renyi probability: epsilon * (n_in + n_out / n_in * n_out).
-                            raw_probabilities[name] = (
-                                                              np.sum(mask.shape) / np.prod(mask.shape)
-                                                      ) ** erk_power_scale
-                            # Note that raw_probabilities[mask] * n_param gives the individual
-                            # elements of the divisor.
-                            divisor += raw_probabilities[name] * n_param
-                    # By multipliying individual probabilites with epsilon, we should get the
-                    # number of parameters per layer correctly.
-                    epsilon = rhs / divisor
-                    # If epsilon * raw_probabilities[mask.name] > 1. We set the sparsities of that
-                    # mask to 0., so they become part of dense_layers sets.
-                    max_prob = np.max(list(raw_probabilities.values()))
-                    max_prob_one = max_prob * epsilon
-                    if max_prob_one > 1:
-                        is_epsilon_valid = False
-                        for mask_name, mask_raw_prob in raw_probabilities.items():
-                            if mask_raw_prob == max_prob:
-                                # print(f"Sparsity of var:{mask_name} had to be set to 0.")
-                                dense_layers.add(mask_name)
-                    else:
-                        is_epsilon_valid = True
-
-                # With the valid epsilon, we can set sparsities of the remaning layers.
-                for name, mask in self.masks.items():
-                    n_param = np.prod(mask.shape)
-                    if name in dense_layers:
-                        self.layer_wise_sparsity[name] = 1.0
-                    else:
-                        probability_one = epsilon * raw_probabilities[name]
-                        self.layer_wise_sparsity[name] = probability_one
-                    # print(
-                    #     f"layer: {name}, shape: {mask.shape}, density: {density_dict[name]}"
-                    # )
-
-            total_nonzero = 0.0
-            total_weight = 0.0
-            generator = torch.Generator(device='cuda')
-            generator.manual_seed(int(mask_index))
-            # With the valid epsilon, we can set sparsities of the remaning layers.
+                if mode == 'NM':
+                    self.layer_wise_sparsity = {name: self.nm_sparsity[0] / self.nm_sparsity[1] for name in self.masks}
+                    self.baseline_nonzero = sum(mask.numel() * self.layer_wise_sparsity[name] for name, mask in self.masks.items())
+                else:
+                    self.compute_erk_densities(density, erk_power_scale)
+                self.print_overall_density()
+
+            # the masks of a group are only generated when it is first used, see bank_masks
+            self.switch_mask(mask_index)
+
+    def compute_erk_densities(self, density, erk_power_scale=1.0):
+        """Sets self.layer_wise_sparsity to the Erdos-Renyi-Kernel density of every layer."""
+        total_params = 0
+        self.baseline_nonzero = 0
+        for name, weight in self.masks.items():
+            total_params += weight.numel()
+            self.baseline_nonzero += weight.numel() * density
+        is_epsilon_valid = False
+        dense_layers = set()
+        while not is_epsilon_valid:
+            divisor = 0
+            rhs = 0
+            raw_probabilities = {}
             for name, mask in self.masks.items():
-                self.masks[name][:] = torch.rand(mask.shape, generator=generator, device='cuda') < self.layer_wise_sparsity[name]
-                total_nonzero += self.layer_wise_sparsity[name] * mask.numel()
-                total_weight += mask.numel()
-            print(f"Overall sparsity {total_nonzero / total_weight}")
+                n_param = np.prod(mask.shape)
+                n_zeros = n_param * (1 - density)
+                n_ones = n_param * density
+
+                if name in dense_layers:
+                    # See `- default_sparsity * (N_3 + N_4)` part of the equation above.
+                    rhs -= n_zeros
+
+                else:
+                    # Corresponds to `(1 - default_sparsity) * (N_1 + N_2)` part of the
+                    # equation above.
+                    rhs += n_ones
+                    # Erdos-Renyi probability: epsilon * (n_in + n_out / n_in * n_out).
+                    raw_probabilities[name] = (
+                                                      np.sum(mask.shape) / np.prod(mask.shape)
+                                              ) ** erk_power_scale
+                    # Note that raw_probabilities[mask] * n_param gives the individual
+                    # elements of the divisor.
+                    divisor += raw_probabilities[name] * n_param
+            # By multipliying individual probabilites with epsilon, we should get the
+            # number of parameters per layer correctly.
+            epsilon = rhs / divisor
+            # If epsilon * raw_probabilities[mask.name] > 1. We set the sparsities of that
+            # mask to 0., so they become part of dense_layers sets.
+            max_prob = np.max(list(raw_probabilities.values()))
+            max_prob_one = max_prob * epsilon
+            if max_prob_one > 1:
+                is_epsilon_valid = False
+                for mask_name, mask_raw_prob in raw_probabilities.items():
+                    if mask_raw_prob == max_prob:
+                        # print(f"Sparsity of var:{mask_name} had to be set to 0.")
+                        dense_layers.add(mask_name)
+            else:
+                is_epsilon_valid = True
 
+        # With the valid epsilon, we can set sparsities of the remaning layers.
+        for name, mask in self.masks.items():
+            n_param = np.prod(mask.shape)
+            if name in dense_layers:
+                self.layer_wise_sparsity[name] = 1.0
+            else:
+                probability_one = epsilon * raw_probabilities[name]
+                self.layer_wise_sparsity[name] = probability_one
+            # print(
+            #     f"layer: {name}, shape: {mask.shape}, density: {density_dict[name]}"
+            # )
+
+    def group_seed(self, mask_index):
+        """Seed of the generated masks of group `mask_index`."""
+        # ERK_local groups all start from the masks of group 0
+        return 0 if self.mask_mode == 'ERK_local' else mask_index
+
+    def generate_masks(self, seed):
+        if self.mask_generator == 'hash':
+            return self.generate_hash_masks(seed)
+        generator = torch.Generator(device=self.generator_device)
+        generator.manual_seed(int(seed))
+        masks = {}
+        for name, mask in self.masks.items():
+            # layers whose input channels do not split into groups of M get unstructured masks
+            if self.mask_mode == 'NM' and mask.shape[1] % self.nm_sparsity[1] == 0:
+                masks[name] = self.nm_mask(mask.shape, generator)
+            elif self.mask_mode == 'ERK_channel':
+                masks[name] = self.channel_mask(mask.shape, self.layer_wise_sparsity[name], generator)
+            else:
+                masks[name] = torch.rand(mask.shape, generator=generator, device=self.generator_device) < self.layer_wise_sparsity[name]
+            masks[name] = masks[name].to(self.device)
+        return masks
+
+    def generator_signature(self):
+        """What the generated masks depend on besides the layer densities, see `check_generator`."""
+        if self.mask_generator == 'hash':
+            return {'generator': 'hash', 'seed': self.mask_seed}
+        return {'generator': 'torch', 'device': self.generator_device.type}
+
+    def check_generator(self, signature, source):
+        """Raises if `signature`, a `generator_signature` saved with `source`, would generate other masks."""
+        if signature is not None and signature != self.generator_signature():
+            raise ValueError(f"The masks of {source} were generated by {signature}, this model generates them "
+                             f"by {self.generator_signature()}. Set mask_generator, mask_seed and generator_device "
+                             f"to match, or the weights are trained under other masks")
+
+    def generate_hash_masks(self, group):
+        """`generate_masks` with counter-based scores instead of a generator, see `hash_mask`."""
+        masks = {}
+        for name, mask in self.masks.items():
+            key = hash_key(self.mask_seed, int(group), name)
+            if self.mask_mode == 'NM' and mask.shape[1] % self.nm_sparsity[1] == 0:
+                masks[name] = self.nm_mask(mask.shape, key=key)
+            elif self.mask_mode == 'ERK_channel':
+                # one score per output channel
+                masks[name] = self.channel_mask(mask.shape, self.layer_wise_sparsity[name],
+                                                scores=hash_scores(key, 0, mask.shape[0], mask.device))
+            else:
+                masks[name] = hash_mask(key, mask.shape, self.layer_wise_sparsity[name], mask.device)
+        return masks
+
+    def nm_mask(self, shape, generator=None, key=None, tile_size=2**20):
+        """Keeps N random entries out of every M consecutive input channels.
+
+        With `key`, the scores are counter-based, see `hash_scores`, and generated tile by
+        tile like in `hash_mask`, so the int64 scores of at most `tile_size` entries exist
+        at any time.
+        """
+        n, m = self.nm_sparsity
+        # (out, in, *kernel) -> groups of m along in
+        perm_shape = (shape[0],) + tuple(shape[2:]) + (shape[1],)
+        if key is None:
+            scores = torch.rand(perm_shape, generator=generator, device=self.generator_device).view(-1, m)
+            keep = scores.topk(n, dim=-1)[1]
+            mask = torch.zeros_like(scores, dtype=torch.bool).scatter_(-1, keep, True)
+        else:
+            mask = torch.zeros(int(np.prod(shape)) // m, m, dtype=torch.bool, device=self.device)
+            # tiles of whole groups of m
+            rows = max(tile_size // m, 1)
+            for row in range(0, mask.shape[0], rows):
+                count = min(rows, mask.shape[0] - row)
+                scores = hash_scores(key, row * m, count * m, self.device).view(-1, m)
+                mask[row:row + count].scatter_(-1, scores.topk(n, dim=-1)[1], True)
+        dims = [0, len(shape) - 1] + list(range(1, len(shape) - 1))
+        return mask.view(perm_shape).permute(*dims).contiguous()
+
+    def channel_mask(self, shape, density, generator=None, scores=None):
+        """Keeps whole output channels, round(density * out_channels) of them chosen at random."""
+        n_keep = max(1, int(round(density * shape[0])))
+        if scores is None:
+            scores = torch.rand(shape[0], generator=generator, device=self.generator_device)
+        keep = scores.topk(n_keep)[1]
+        mask = torch.zeros(shape[0], dtype=torch.bool, device=scores.device)
+        mask[keep] = True
+        return mask.view(-1, *([1] * (len(shape) - 1))).expand(shape).contiguous()
+
+    def mask_key(self, mask_index):
+        """Digest identifying the masks of group `mask_index`, equal in every process that uses
+        the same masks. Generated masks are identified by how they are generated, see
+        `generated_key`, modified masks by their content."""
+        key = self.mask_keys.get(mask_index)
+        if key is None:
+            key = self.generated_key(mask_index)
+            self.mask_keys[mask_index] = key
+        return key
+
+    def generated_key(self, mask_index):
+        signature = [self.generator_signature(), self.mask_mode, list(self.nm_sparsity), self.group_seed(mask_index),
+                     sorted(self.layer_wise_sparsity.items())]
+        return hashlib.sha1(json.dumps(signature).encode()).hexdigest()
+
+    def modified_groups(self):
+        """Groups whose masks are not the generated ones, e.g. since they were pruned and regrown."""
+        return sorted(index for index, key in self.mask_keys.items() if key != self.generated_key(index))
+
+    def print_overall_density(self):
+        total_nonzero = 0.0
+        total_weight = 0.0
+        for name, mask in self.masks.items():
+            total_nonzero += self.layer_wise_sparsity[name] * mask.numel()
+            total_weight += mask.numel()
+        print(f"Overall sparsity {total_nonzero / total_weight}")
+
+    def switch_mask(self, mask_index):
+        """Activates the masks of group `mask_index` and applies them to the weights.
+
+        Groups held in the mask bank are only selected, without touching the RNG,
+        other groups are added to it first, see `bank_masks`. With masked forward
+        enabled the stored weights are left as they are.
+        """
+        self.load_masks(mask_index)
+        if not self.masked_forward:
             self.apply_mask()
 
+    def load_masks(self, mask_index):
+        mask_index = int(mask_index)
+        self.follow_device()
+        if mask_index == self.mask_index:
+            return
+        self.write_back()
+        packed_masks = self.bank_masks(mask_index)
+        deltas = self.mask_delta(self.mask_index, mask_index)
+        if deltas is not None:
+            # flip only the entries that differ from the active group
+            self.ensure_flat()
+            for name, indices in deltas.items():
+                if indices is None:
+                    self.masks[name].copy_(unpack_mask(packed_masks[name], self.masks[name].shape))
+                else:
+                    mask = self.masks[name].view(-1)
+                    indices = indices.long()
+                    mask[indices] = ~mask[indices]
+        elif self.ensure_flat():
+            self.unpack_flat_masks(packed_masks)
+        else:
+            for name, packed in packed_masks.items():
+                self.masks[name] = unpack_mask(packed, self.masks[name].shape)
+        self.mask_index = mask_index
+        self.masks_modified = False
+
+    def write_back(self):
+        """Stores the masks of the active group if they were modified since it was activated."""
+        if self.masks_modified and self.mask_index is not None:
+            packed = self.pack_masks(self.masks)
+            self.host_bank[self.mask_index] = move_packed(packed, 'cpu')
+            self.mask_bank[self.mask_index] = packed
+            self.mask_bank.move_to_end(self.mask_index)
+            self.mask_deltas = {}
+        self.masks_modified = False
+
+    def bank_masks(self, mask_index):
+        """Packed masks of group `mask_index`, added to the mask bank if they are not in it.
+
+        Modified groups are copied from the host bank and groups of a loaded mask plan are
+        paged in from it, all other groups are generated. Adding a group may drop the least
+        recently used ones, see `evict_groups`.
+        """
+        packed = self.mask_bank.get(mask_index)
+        if packed is not None:
+            self.mask_bank.move_to_end(mask_index)
+            return packed
+        packed = self.stored_masks(mask_index)
+        if packed is None:
+            packed = self.pack_masks(self.generate_masks(seed=self.group_seed(mask_index)))
+        self.mask_bank[mask_index] = packed
+        self.evict_groups()
+        return packed
+
+    def stored_masks(self, mask_index):
+        """Packed masks of group `mask_index` from the host bank or the mask plan, None if it has none."""
+        if mask_index in self.host_bank:
+            return move_packed(self.host_bank[mask_index], self.device)
+        if self.mask_plan is not None and 0 <= mask_index < self.mask_plan.shape[0]:
+            return {name: torch.from_numpy(np.array(self.mask_plan[mask_index, offset:offset + nbytes])).to(self.device)
+                    for name, (offset, nbytes) in self.mask_plan_layers.items()}
+        return None
+
+    def evict_groups(self):
+        """Drops the least recently used groups other than the active one from the mask bank while
+        it holds more than mask_bank_bytes. Dropped groups are paged in or generated again when used."""
+        group_bytes = sum((mask.numel() + 7) // 8 for mask in self.masks.values())
+        # the active group and the one switched to always fit
+        capacity = max(2, self.mask_bank_bytes // max(group_bytes, 1))
+        while len(self.mask_bank) > capacity:
+            mask_index = next(iter(self.mask_bank))
+            if mask_index == self.mask_index:
+                self.mask_bank.move_to_end(mask_index)
+                continue
+            del self.mask_bank[mask_index]
+            for key in [key for key in self.mask_deltas if mask_index in key]:
+                del self.mask_deltas[key]
+
+    def mask_delta(self, i, j):
+        """Returns, per layer, the flat indices of the entries that differ between the masks of
+        groups `i` and `j`, or None if the groups are not consecutive groups in the bank.
+
+        Deltas are computed from the XOR of the packed masks on first use and cached until
+        the masks change. Consecutive groups overlap heavily, so switching between them
+        only touches a small fraction of the entries.
+        """
+        if i is None or abs(i - j) != 1 or i not in self.mask_bank or j not in self.mask_bank:
+            return None
+        if self.mask_deltas_version != self.mask_version:
+            self.mask_deltas = {}
+            self.mask_deltas_version = self.mask_version
+        key = (min(i, j), max(i, j))
+        if key not in self.mask_deltas:
+            deltas = {}
+            for name, packed in self.mask_bank[i].items():
+                diff = unpack_mask(packed ^ self.mask_bank[j][name], self.masks[name].shape).view(-1)
+                indices = diff.nonzero(as_tuple=True)[0]
+                deltas[name] = indices.int() if indices.numel() <= self.max_delta_fraction * diff.numel() else None
+            self.mask_deltas[key] = deltas
+        return self.mask_deltas[key]
+
+    def get_group_masks(self, mask_index):
+        """Returns the unpacked masks of group `mask_index` without activating it."""
+        mask_index = int(mask_index)
+        if mask_index == self.mask_index:
+            return self.masks
+        return {name: unpack_mask(packed, self.masks[name].shape) for name, packed in self.bank_masks(mask_index).items()}
+
+    def group_densities(self, mask_indices):
+        """Overall mask density of every group of `mask_indices` as one device tensor, NaN for
+        groups that are neither active nor in the mask bank or the host bank."""
+        counts = []
+        for mask_index in mask_indices:
+            if mask_index == self.mask_index:
+                # the bank copy of the active group may be behind
+                counts.append(self.layer_counts(self.masks).sum().float())
+            elif mask_index in self.mask_bank:
+                counts.append(torch.stack([popcount(packed) for packed in self.mask_bank[mask_index].values()]).sum().float())
+            elif mask_index in self.host_bank:
+                counts.append(torch.stack([popcount(packed) for packed in self.host_bank[mask_index].values()]).sum().float().to(self.device))
+            else:
+                counts.append(torch.tensor(float('nan'), device=self.device))
+        return torch.stack(counts) / sum(mask.numel() for mask in self.masks.values())
+
+    def union_masks(self, mask_indices):
+        """Entries that are active in any of the groups `mask_indices`."""
+        union = None
+        for mask_index in mask_indices:
+            masks = self.get_group_masks(mask_index)
+            if union is None:
+                union = {name: mask.clone() for name, mask in masks.items()}
+            else:
+                for name, mask in masks.items():
+                    union[name] |= mask
+        return union
+
+    def pack_masks(self, masks):
+        return {name: pack_mask(mask) for name, mask in masks.items()}
+
+    def mask_plan_header(self):
+        """Header of the mask plan of the current masks, see `save_mask_plan`.
+
+        Besides the layers it records what the masks were generated from, and the
+        `mask_key` of every group. Its plan_id is a digest of all of that, so two plans
+        share it only if they hold the same masks.
+        """
+        layers = []
+        offset = 0
+        for name, mask in self.masks.items():
+            nbytes = (mask.numel() + 7) // 8
+            layers.append({'name': name, 'shape': list(mask.shape), 'density': float(self.layer_wise_sparsity[name]),
+                           'offset': offset, 'nbytes': nbytes})
+            offset += nbytes
+        header = {'mask_mode': self.mask_mode, 'nm_sparsity': list(self.nm_sparsity), 'num_mask': self.num_mask,
+                  'sparse_init': self.sparse_init, 'init_density': self.init_density,
+                  'generator': self.generator_signature(), 'layers': layers,
+                  'mask_keys': {str(index): self.mask_key(index) for index in range(self.num_mask)}}
+        header['plan_id'] = hashlib.sha1(json.dumps(header, sort_keys=True).encode()).hexdigest()
+        return header
+
+    def save_mask_plan(self, path, header=None):
+        """Saves the layer densities and the packed masks of all groups as a mask plan.
+
+        The plan consists of `path + '.json'`, the `mask_plan_header`, and `path + '.npy'`,
+        holding one row of packed masks per group. `load_mask_plan` memory-maps the
+        latter, so a model restarted from the plan neither reruns the ERK search nor
+        generates masks, and only reads the groups it actually uses. The rows are written
+        one group at a time, groups that are not in the mask bank are not added to it.
+        """
+        self.write_back()
+        if header is None:
+            header = self.mask_plan_header()
+        layers = header['layers']
+        num_groups = header['num_mask']
+        # write next to the old plan first, which may still be memory-mapped
+        plan = np.lib.format.open_memmap(path + '.tmp.npy', mode='w+', dtype=np.uint8,
+                                         shape=(num_groups, sum(layer['nbytes'] for layer in layers)))
+        for index in range(num_groups):
+            packed = self.mask_bank.get(index) or self.stored_masks(index)
+            if packed is None:
+                packed = self.pack_masks(self.generate_masks(seed=self.group_seed(index)))
+            for layer in layers:
+                plan[index, layer['offset']:layer['offset'] + layer['nbytes']] = packed[layer['name']].cpu().numpy()
+        plan.flush()
+        del plan
+        os.replace(path + '.tmp.npy', path + '.npy')
+        with open(path + '.json.tmp', 'w') as f:
+            json.dump(header, f)
+        os.replace(path + '.json.tmp', path + '.json')
+        print(f"Saved mask plan with {num_groups} groups to {path}")
+
+    def load_mask_plan(self, path, plan_id=None):
+        """Loads a mask plan written by `save_mask_plan`. Has to be called after `add_module`
+        and before `init`, which then only selects groups of the plan.
+
+        Raises if the plan was generated for other masks than the ones configured, or is
+        not the plan `plan_id` of a checkpoint.
+        """
+        with open(path + '.json') as f:
+            header = json.load(f)
+        if plan_id is not None and header.get('plan_id') != plan_id:
+            raise ValueError(f"Mask plan {path} is not the mask plan {plan_id} the checkpoint was saved with")
+        self.check_mask_header(header, f"Mask plan {path}")
+        self.use_mask_header(header)
+        layers = {layer['name']: layer for layer in header['layers']}
+        self.mask_plan = np.load(path + '.npy', mmap_mode='r')
+        self.mask_plan_layers = {name: (layers[name]['offset'], layers[name]['nbytes']) for name in self.masks}
+        print(f"Loaded mask plan with {self.mask_plan.shape[0]} groups from {path}")
+        self.print_overall_density()
+
+    def check_mask_header(self, header, source):
+        """Raises if the `mask_plan_header` `header` of `source` is for other masks than the ones configured."""
+        # groups that are not stored are generated, with the generator of the header
+        self.check_generator(header.get('generator'), source)
+        # plans written before these were recorded are taken as they are
+        expected = {'num_mask': self.num_mask, 'sparse_init': self.sparse_init, 'init_density': self.init_density,
+                    'nm_sparsity': list(self.nm_sparsity)}
+        for key, value in expected.items():
+            if key in header and header[key] != value:
+                raise ValueError(f"{source} has {key} {header[key]}, the model has {value}")
+        layers = {layer['name']: layer for layer in header['layers']}
+        if set(layers) != set(self.masks):
+            raise ValueError(f"{source} does not match the masked layers of the model")
+        for name, mask in self.masks.items():
+            if tuple(layers[name]['shape']) != tuple(mask.shape):
+                raise ValueError(f"{source} has shape {layers[name]['shape']} for {name}, "
+                                 f"the model has {list(mask.shape)}")
+
+    def use_mask_header(self, header):
+        """Takes the mask mode, layer densities and mask keys of a checked header, so that `init`
+        skips the ERK search, and drops the masks of all groups."""
+        layers = {layer['name']: layer for layer in header['layers']}
+        self.mask_mode = header['mask_mode']
+        self.layer_wise_sparsity = {name: layers[name]['density'] for name in self.masks}
+        self.baseline_nonzero = sum(mask.numel() * self.layer_wise_sparsity[name] for name, mask in self.masks.items())
+        self.mask_bank = OrderedDict()
+        self.host_bank = {}
+        self.mask_deltas = {}
+        self.mask_keys = {int(index): key for index, key in header.get('mask_keys', {}).items()}
+        self.mask_index = None
+        self.masks_modified = False
+        self.mask_version += 1
+
+    def modified_group_state(self):
+        """The `mask_plan_header` and the packed masks of the `modified_groups`, on the host.
+
+        Groups that are not modified are generated again from the header, so a checkpoint
+        only has to hold the modified ones, which are already on the host. See
+        `load_modified_group_state`.
+        """
+        self.write_back()
+        header = self.mask_plan_header()
+        groups = {}
+        for index in self.modified_groups():
+            if index in self.host_bank:
+                packed = self.host_bank[index]
+                groups[index] = torch.cat([packed[name] for name in self.masks])
+            elif self.mask_plan is not None and 0 <= index < self.mask_plan.shape[0]:
+                groups[index] = torch.cat([torch.from_numpy(np.array(self.mask_plan[index, offset:offset + nbytes]))
+                                           for offset, nbytes in (self.mask_plan_layers[name] for name in self.masks)])
+            else:
+                raise RuntimeError(f"The modified masks of group {index} are neither in the host bank nor in the mask plan")
+        return {'header': header, 'groups': groups}
+
+    def load_modified_group_state(self, state, source):
+        """Restores the masks of a `modified_group_state` of `source`. Like `load_mask_plan`, has
+        to be called after `add_module` and before `init`. Groups of a loaded mask plan that
+        are not in the state are still paged in from the plan."""
+        header = state['header']
+        self.check_mask_header(header, source)
+        self.use_mask_header(header)
+        sizes = {layer['name']: layer['nbytes'] for layer in header['layers']}
+        names = [layer['name'] for layer in header['layers']]
+        for index, row in state['groups'].items():
+            self.host_bank[int(index)] = dict(zip(names, row.split([sizes[name] for name in names])))
+        print(f"Restored the masks of {len(state['groups'])} modified groups from {source}")
+        self.print_overall_density()
 
     def init_growth_prune_and_redist(self):
         if isinstance(self.growth_func, str) and self.growth_func in growth_funcs:
@@ -455,15 +1108,21 @@ class Masking(object):
     def add_module(self, module):
         self.modules.append(module)
         self.module = module
+        if self.device is None:
+            self.device = next(module.parameters()).device
 
         for module in self.modules:
             for name, tensor in module.named_parameters():
                 if len(tensor.size()) == 2 or len(tensor.size()) == 4:
                     self.names.append(name)
-                    self.masks[name] = torch.zeros_like(tensor, dtype=torch.float32, requires_grad=False).to(self.device)
+                    self.masks[name] = torch.zeros_like(tensor, dtype=torch.bool, requires_grad=False).to(self.device)
         print('label_emb...')
         self.remove_weight_partial_name('label_emb')
         self.remove_weight_partial_name('time_embed')
+        for module in self.modules:
+            for name, tensor in module.named_parameters():
+                if name in self.masks:
+                    self.weight2name[tensor] = name
         # # print('Removing fisrt layer...')
         # # self.remove_weight_partial_name('conv1.weight')
         # print('Removing 2D batch norms...')
@@ -522,24 +1181,118 @@ class Masking(object):
     def print_status(self):
         total_size = 0
         sparse_size = 0
+        weights = {}
         for module in self.modules:
             for name, weight in module.named_parameters():
                 if name not in self.masks: continue
-                dense_weight_num = weight.numel()
-                sparse_weight_num = (weight != 0).sum().int().item()
-                total_size += dense_weight_num
-                sparse_size += sparse_weight_num
-                layer_density = sparse_weight_num / dense_weight_num
-                print(f'sparsity of layer {name} with tensor {weight.size()} is {1-layer_density}')
+                weights[name] = weight.data
+        for (name, weight), sparse_weight_num in zip(weights.items(), self.layer_counts(weights).tolist()):
+            dense_weight_num = weight.numel()
+            total_size += dense_weight_num
+            sparse_size += sparse_weight_num
+            layer_density = sparse_weight_num / dense_weight_num
+            print(f'sparsity of layer {name} with tensor {weight.size()} is {1-layer_density}')
         print('Final sparsity level is {0}'.format(1 - sparse_size / total_size))
 
+    def flatten(self):
+        """Moves all masked weights and their masks into one flat buffer each.
+
+        The parameters and the entries of `self.masks` become views into
+        `self.flat_weights` and `self.flat_mask`, so applying the masks, switching groups
+        and counting nonzeros each run over a single buffer. Every layer starts at a
+        multiple of FLAT_CHUNK elements, the padding is masked out. Has to be called
+        again after the weights were moved to another device, see `ensure_flat`.
+        """
+        params = {}
+        for module in self.modules:
+            for name, tensor in module.named_parameters():
+                if name in self.masks:
+                    params[name] = tensor
+        dtypes = set(tensor.dtype for tensor in params.values())
+        devices = set(tensor.device for tensor in params.values())
+        if len(dtypes) > 1 or len(devices) > 1:
+            raise ValueError(f"Flat buffers need masked weights of one dtype and device, got {dtypes} and {devices}")
+
+        self.flat_layout = {}
+        offset = 0
+        for name, tensor in params.items():
+            self.flat_layout[name] = offset
+            offset += -(-tensor.numel() // FLAT_CHUNK) * FLAT_CHUNK
+        tensor = next(iter(params.values()))
+        self.flat_weights = torch.zeros(offset, dtype=tensor.dtype, device=tensor.device)
+        self.flat_mask = torch.zeros(offset, dtype=torch.bool, device=tensor.device)
+        chunk_layer = []
+        for index, (name, tensor) in enumerate(params.items()):
+            start, numel = self.flat_layout[name], tensor.numel()
+            weight_view = self.flat_weights[start:start + numel].view(tensor.shape)
+            weight_view.copy_(tensor.data)
+            tensor.data = weight_view
+            mask_view = self.flat_mask[start:start + numel].view(tensor.shape)
+            mask_view.copy_(self.masks[name])
+            self.masks[name] = mask_view
+            chunk_layer += [index] * (-(-numel // FLAT_CHUNK))
+        self.flat_params = params
+        # layer of every chunk, to sum the per-chunk counts up per layer
+        self.flat_chunk_layer = torch.tensor(chunk_layer, dtype=torch.long, device=tensor.device)
+        # zero bytes between the packed layers, so that the concatenated bank entry of a group
+        # unpacks to the flat layout at once
+        self.flat_pads = {}
+        for name, tensor in params.items():
+            pad = -(-tensor.numel() // FLAT_CHUNK) * FLAT_CHUNK // 8 - -(-tensor.numel() // 8)
+            self.flat_pads[name] = torch.zeros(pad, dtype=torch.uint8, device=tensor.device)
+
+    def ensure_flat(self):
+        """Returns whether the flat buffers are in use, and rebuilds them if the weights
+        were moved away from them, e.g. to another device."""
+        if not self.flat_buffers or self.half:
+            return False
+        # moving the module moves all of its parameters, so checking the first one is enough
+        if self.flat_weights is None or next(iter(self.flat_params.values())).data_ptr() != self.flat_weights.data_ptr():
+            self.flatten()
+        return True
+
+    def unpack_flat_masks(self, packed):
+        pieces = []
+        for name in self.flat_layout:
+            pieces += [packed[name], self.flat_pads[name]]
+        self.flat_mask.copy_(unpack_mask(torch.cat(pieces).to(self.flat_mask.device), self.flat_mask.shape))
+
+    def follow_device(self):
+        """Moves the masks to the device of the masked weights if the weights were moved,
+        e.g. when Lightning moves the model to the GPU after the masks were initialized."""
+        if not self.weight2name:
+            return
+        # moving the module moves all of its parameters, so checking one of them is enough
+        device = next(iter(self.weight2name)).device
+        if device != torch.device(self.device):
+            self.to(device)
+
+    def to(self, device):
+        """Moves the masks, the mask bank and all other per-weight state of the masking to `device`.
+        The host bank and the fired bitsets stay on the host."""
+        self.device = torch.device(device)
+        self.masks = {name: mask.to(device) for name, mask in self.masks.items()}
+        self.mask_bank = OrderedDict((index, {name: packed.to(device) for name, packed in packed_masks.items()})
+                                     for index, packed_masks in self.mask_bank.items())
+        if self.stored_weights is not None:
+            self.stored_weights = {name: weight.to(device) for name, weight in self.stored_weights.items()}
+        self.mask_deltas = {}
+        # the flat buffers are rebuilt around the moved weights on next use
+        self.flat_weights = None
+        self.flat_mask = None
+        return self
+
     def apply_mask(self):
+        self.follow_device()
+        if self.ensure_flat():
+            self.flat_weights.mul_(self.flat_mask)
+            return
 
         for module in self.modules:
             for name, tensor in module.named_parameters():
                 if name in self.masks:
                     if not self.half:
-                        tensor.data.copy_(tensor.data*self.masks[name].to(tensor.device))
+                        tensor.data.mul_(self.masks[name].to(tensor.device))
                         # if 'momentum_buffer' in self.optimizer.state[tensor]:
                         #     self.optimizer.state[tensor]['momentum_buffer'] = self.optimizer.state[tensor]['momentum_buffer']*self.masks[name]
                     else:
@@ -549,6 +1302,95 @@ class Masking(object):
                             tensor2.data = tensor2.data*self.masks[name]
 
 
+    def enable_masked_forward(self):
+        """Masks the weights on the fly in the forward pass of every masked module.
+
+        The stored weights stay dense and are never overwritten. The gradients of
+        inactive entries are zero, and `MaskedAdamW` leaves them untouched.
+        """
+        if self.masked_forward: return
+        for module in self.modules:
+            for module_name, submodule in module.named_modules():
+                params = []
+                for param_name, _ in submodule.named_parameters(recurse=False):
+                    name = module_name + '.' + param_name if module_name else param_name
+                    if name in self.masks:
+                        params.append((param_name, name))
+                if params:
+                    submodule.register_forward_pre_hook(partial(self._mask_weights_hook, params))
+                    submodule.register_forward_hook(partial(self._unmask_weights_hook, params))
+        # checkpointed blocks recompute their forward in the backward pass, with the masks of their forward pass
+        register_checkpoint_context(self.forward_masks_context)
+        self.masked_forward = True
+
+    @contextmanager
+    def use_forward_masks(self, masks):
+        """Masks the forward passes in this context with `masks` instead of the active group."""
+        previous = self.forward_masks
+        self.forward_masks = masks
+        try:
+            yield
+        finally:
+            self.forward_masks = previous
+
+    def forward_masks_context(self):
+        return self.use_forward_masks(self.forward_masks)
+
+    def _mask_weights_hook(self, params, module, input):
+        if self.stored_weights is not None:
+            # the weights are already masked in place, see activate_mask
+            return
+        # instance attributes take precedence over the registered parameters,
+        # so the module computes with the masked weights during this call
+        masks = self.masks if self.forward_masks is None else self.forward_masks
+        for param_name, name in params:
+            weight = module._parameters[param_name]
+            module.__dict__[param_name] = weight * masks[name].to(weight.device)
+
+    def _unmask_weights_hook(self, params, module, input, output):
+        for param_name, _ in params:
+            module.__dict__.pop(param_name, None)
+
+    def store_weights(self):
+        """Keeps a copy of the dense masked weights, so that `activate_mask` can mask
+        them in place and `restore_weights` can undo it afterwards."""
+        self.follow_device()
+        self.stored_weights = {}
+        for module in self.modules:
+            for name, tensor in module.named_parameters():
+                if name in self.masks:
+                    self.stored_weights[name] = tensor.detach().clone()
+        self.applied_mask_index = None
+
+    def activate_mask(self, mask_index):
+        """Masks the stored weights with group `mask_index`, only if that group is not applied yet."""
+        mask_index = int(mask_index)
+        if mask_index == self.applied_mask_index:
+            return
+        self.load_masks(mask_index)
+        deltas = self.mask_delta(self.applied_mask_index, mask_index) or {}
+        for module in self.modules:
+            for name, tensor in module.named_parameters():
+                if name not in self.stored_weights:
+                    continue
+                indices = deltas.get(name)
+                if indices is None:
+                    torch.mul(self.stored_weights[name], self.masks[name].to(tensor.device), out=tensor.data)
+                else:
+                    # entries turned on get their stored value back, entries turned off are zeroed
+                    indices = indices.long()
+                    weight = tensor.data.view(-1)
+                    weight[indices] = self.stored_weights[name].view(-1)[indices] * self.masks[name].view(-1)[indices]
+        self.applied_mask_index = mask_index
+
+    def restore_weights(self):
+        for module in self.modules:
+            for name, tensor in module.named_parameters():
+                if name in self.stored_weights:
+                    tensor.data.copy_(self.stored_weights[name])
+        self.stored_weights = None
+        self.applied_mask_index = None
+
     def adjust_prune_rate(self):
         for module in self.modules:
             for name, weight in module.named_parameters():
@@ -569,31 +1411,132 @@ class Masking(object):
 
 
     def truncate_weights(self):
-
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                mask = self.masks[name]
-                self.name2nonzeros[name] = mask.sum().item()
-                self.name2zeros[name] = mask.numel() - self.name2nonzeros[name]
-                # prune
-                new_mask = self.prune_func(self, mask, weight, name)
-                removed = self.name2nonzeros[name] - new_mask.sum().item()
+        self.follow_device()
+        if self.mask_index not in self.fired_bank:
+            # the masks before the first update of a group have been active as well
+            self.update_fired()
+        # batching the layers saves kernel launches and syncs on the GPU, on CPU the per-layer topk is faster
+        if self.prune_func in batched_prune_funcs and self.growth_func in batched_growth_funcs and \
+                all(mask.is_cuda for mask in self.masks.values()):
+            self.truncate_weights_batched()
+            return
+
+        if self.global_prune:
+            # global prune functions handle all layers and fill name2removed themselves
+            self.total_removed += self.prune_func(self)
+        else:
+            # the counts are read back once for all layers, before and after pruning
+            nonzeros = self.layer_counts(self.masks).tolist()
+            for (name, mask), nonzero in zip(self.masks.items(), nonzeros):
+                self.name2nonzeros[name] = nonzero
+                self.name2zeros[name] = mask.numel() - nonzero
+            for module in self.modules:
+                for name, weight in module.named_parameters():
+                    if name not in self.masks: continue
+                    # prune
+                    new_mask = self.prune_func(self, self.masks[name], weight, name)
+                    self.masks[name][:] = new_mask
+            for (name, mask), nonzero in zip(self.masks.items(), self.layer_counts(self.masks).tolist()):
+                removed = self.name2nonzeros[name] - nonzero
                 self.total_removed += removed
                 self.name2removed[name] = removed
-                self.masks[name][:] = new_mask
 
+        if self.global_growth:
+            self.growth_func(self, sum(math.floor(self.name2removed[name]) for name in self.masks))
+        else:
+            for module in self.modules:
+                for name, weight in module.named_parameters():
+                    if name not in self.masks: continue
+                    new_mask = self.masks[name].data.byte()
+                    # growth
+                    new_mask = self.growth_func(self, name, new_mask, math.floor(self.name2removed[name]), weight)
+                    # exchanging masks
+                    # self.masks.pop(name)
+                    self.masks[name][:] = new_mask.float()
+
+        self.finish_truncation()
+
+    def layer_counts(self, tensors):
+        """Nonzero counts of a dict of tensors as one device tensor, in the order of the dict."""
+        if tensors is self.masks and self.ensure_flat():
+            chunk_counts = self.flat_mask.view(-1, FLAT_CHUNK).sum(dim=1)
+            counts = torch.zeros(len(self.flat_layout), dtype=torch.long, device=self.flat_mask.device)
+            return counts.index_add_(0, self.flat_chunk_layer, chunk_counts)
+        return torch.stack([(tensor != 0).sum() for tensor in tensors.values()])
+
+    def update_metrics(self):
+        """Reads the layer statistics back from the device in one transfer.
+
+        Returns and stores in `self.metrics` the density of every layer and of the
+        whole model, the weights removed by the last prune step and, if fired masks
+        are tracked, the fraction of weights that have been active at some point.
+        """
+        names = list(self.masks)
+        fired_masks = self.fired_masks
+        fired_names = [name for name in names if name in fired_masks]
+        counts = self.layer_counts(self.masks)
+        if fired_names:
+            counts = torch.cat([counts, torch.stack([popcount(fired_masks[name]) for name in fired_names]).to(counts.device)])
+        counts = counts.tolist()
+        nonzeros, fired = counts[:len(names)], counts[len(names):]
+
+        metrics = {}
+        total = 0
+        for name, nonzero in zip(names, nonzeros):
+            metrics[f'sparsity/density/{name}'] = nonzero / self.masks[name].numel()
+            if name in self.name2removed:
+                metrics[f'sparsity/removed/{name}'] = float(self.name2removed[name])
+            total += self.masks[name].numel()
+        metrics['sparsity/density'] = sum(nonzeros) / total
+        metrics['sparsity/removed'] = float(sum(self.name2removed.values()))
+        metrics['sparsity/prune_rate'] = float(self.prune_rate)
+        for name, count in zip(fired_names, fired):
+            metrics[f'sparsity/fired/{name}'] = count / self.masks[name].numel()
+        if fired_names:
+            metrics['sparsity/fired'] = sum(fired) / sum(self.masks[name].numel() for name in fired_names)
+        self.metrics = metrics
+        return metrics
+
+    def truncate_weights_batched(self):
+        """`truncate_weights` with prune and growth functions that handle all layers at once.
+
+        The counts of all layers are read back in one transfer instead of one per layer.
+        """
+        names, weights = [], []
         for module in self.modules:
             for name, weight in module.named_parameters():
                 if name not in self.masks: continue
-                new_mask = self.masks[name].data.byte()
-                # growth
-                new_mask = self.growth_func(self, name, new_mask, math.floor(self.name2removed[name]), weight)
-                # exchanging masks
-                # self.masks.pop(name)
-                self.masks[name][:] = new_mask.float()
-
-        self.apply_mask()
+                names.append(name)
+                weights.append(weight)
+        masks = [self.masks[name] for name in names]
+
+        nonzeros = torch.stack([mask.sum() for mask in masks]).tolist()
+        for name, mask, nonzero in zip(names, masks, nonzeros):
+            self.name2nonzeros[name] = nonzero
+            self.name2zeros[name] = mask.numel() - nonzero
+        # prune
+        new_masks = batched_prune_funcs[self.prune_func](self, names, masks, weights)
+        remaining = torch.stack([mask.sum() for mask in new_masks]).tolist()
+        for name, nonzero in zip(names, remaining):
+            removed = self.name2nonzeros[name] - nonzero
+            self.total_removed += removed
+            self.name2removed[name] = removed
+        # growth
+        new_masks = batched_growth_funcs[self.growth_func](self, names, new_masks,
+                                                           [math.floor(self.name2removed[name]) for name in names], weights)
+        for name, new_mask in zip(names, new_masks):
+            self.masks[name][:] = new_mask
+
+        self.finish_truncation()
+
+    def finish_truncation(self):
+        self.masks_modified = True
+        self.mask_version += 1
+        packed = self.pack_masks(self.masks)
+        self.mask_keys[self.mask_index] = packed_digest(packed)
+        self.update_fired(packed)
+        if not self.masked_forward:
+            self.apply_mask()
 
     '''
                 UTILITY
@@ -608,40 +1551,71 @@ class Masking(object):
 
         return grad
 
+    def get_mask_for_weight(self, weight):
+        name = self.weight2name.get(weight)
+        if name is None or name not in self.masks: return None
+        if self.update_masks is not None:
+            return self.update_masks[name]
+        return self.masks[name]
+
     def get_gradient_for_weights(self, weight):
         grad = weight.grad.clone()
         return grad
 
     def print_nonzero_counts(self):
-        for module in self.modules:
-            for name, tensor in module.named_parameters():
-                if name not in self.masks: continue
-                mask = self.masks[name]
-                num_nonzeros = (mask != 0).sum().item()
-                val = '{0}: {1}->{2}, density: {3:.3f}'.format(name, self.name2nonzeros[name], num_nonzeros,
-                                                               num_nonzeros / float(mask.numel()))
-                print(val)
+        metrics = self.update_metrics()
+        for name, mask in self.masks.items():
+            density = metrics[f'sparsity/density/{name}']
+            val = '{0}: {1}->{2}, density: {3:.3f}'.format(name, self.name2nonzeros.get(name), round(density * mask.numel()),
+                                                           density)
+            print(val)
 
         print('Prune rate: {0}\n'.format(self.prune_rate))
 
+    @property
+    def fired_masks(self):
+        """Packed fired bitsets of the active group, empty if the group has none yet."""
+        return self.fired_bank.get(self.mask_index, {})
+
+    def update_fired(self, packed=None):
+        """ORs the active masks, or their packed form `packed`, into the fired bitsets of the
+        active group. The bitsets of all layers move between host and device at once."""
+        if not self.track_fired or self.mask_index is None:
+            return
+        if packed is None:
+            packed = self.pack_masks(self.masks)
+        fired = self.fired_bank.get(self.mask_index)
+        if fired is not None:
+            fired = move_packed(fired, next(iter(packed.values())).device)
+            packed = {name: bits | fired[name] for name, bits in packed.items()}
+        self.fired_bank[self.mask_index] = move_packed(packed, 'cpu')
+
+    def get_fired_mask(self, name):
+        """Unpacked fired bitset of layer `name` in the active group, the active mask if none is tracked."""
+        fired = self.fired_masks.get(name)
+        if fired is None:
+            return self.masks[name].bool()
+        return unpack_mask(fired.to(self.masks[name].device), self.masks[name].shape)
+
     def fired_masks_update(self):
-        ntotal_fired_weights = 0.0
-        ntotal_weights = 0.0
+        self.update_fired()
+        metrics = self.update_metrics()
         layer_fired_weights = {}
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                self.fired_masks[name] = self.masks[name].data.byte() | self.fired_masks[name].data.byte()
-                ntotal_fired_weights += float(self.fired_masks[name].sum().item())
-                ntotal_weights += float(self.fired_masks[name].numel())
-                layer_fired_weights[name] = float(self.fired_masks[name].sum().item())/float(self.fired_masks[name].numel())
-                # print('Layerwise percentage of the fired weights of', name, 'is:', layer_fired_weights[name])
-        total_fired_weights = ntotal_fired_weights/ntotal_weights
+        for name in self.masks:
+            layer_fired_weights[name] = metrics[f'sparsity/fired/{name}']
+        # print('Layerwise percentage of the fired weights of', name, 'is:', layer_fired_weights[name])
+        total_fired_weights = metrics['sparsity/fired']
         print('The percentage of the total fired weights is:', total_fired_weights)
         return layer_fired_weights, total_fired_weights
 
-    def synchronism_masks(self):
-
-        for name in self.masks.keys():
-            torch.distributed.broadcast(self.masks[name], src=0, async_op=False)
+    def synchronism_masks(self, bucket_bytes=2**24):
+        """Makes the masks of all ranks equal to the ones of rank 0, see `broadcast_masks`."""
+        broadcast_masks(self.masks, src=0, bucket_bytes=bucket_bytes)
+        self.masks_modified = True
+        self.mask_version += 1
+        packed = self.pack_masks(self.masks)
+        self.mask_keys[self.mask_index] = packed_digest(packed)
+        self.update_fired(packed)
+        if not self.masked_forward:
+            self.apply_mask()
 
@@ -0,0 +1,167 @@
+"""SAMPLING ONLY.
+
+Runs the pruned conv and linear layers of a masked UNet with sparse kernels on CPU,
+so that the cost of a forward pass drops with the density of the masks.
+"""
+
+import copy
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def to_sparse_weight(weight):
+    """Compresses a 2D weight matrix, as CSR when supported and as COO otherwise."""
+    weight = weight.detach().contiguous()
+    if hasattr(weight, 'to_sparse_csr'):
+        return weight.to_sparse_csr()
+    return weight.to_sparse()
+
+
+def weight_sparsity(weight):
+    return 1.0 - float((weight != 0).sum()) / weight.numel()
+
+
+class SparseLinear(nn.Module):
+    """Inference replacement of nn.Linear holding a compressed weight."""
+    def __init__(self, linear):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.weight = to_sparse_weight(linear.weight)
+        self.bias = None if linear.bias is None else linear.bias.detach().clone()
+
+    def forward(self, x):
+        shape = x.shape
+        out = torch.sparse.mm(self.weight, x.reshape(-1, shape[-1]).t()).t()
+        if self.bias is not None:
+            out = out + self.bias
+        return out.reshape(*shape[:-1], self.out_features)
+
+
+class SparseConv(nn.Module):
+    """Inference replacement of nn.Conv1d/nn.Conv2d (groups=1) as im2col + sparse matmul."""
+    def __init__(self, conv):
+        super().__init__()
+        self.dims = conv.weight.dim() - 2
+        self.out_channels = conv.out_channels
+        if self.dims == 1:
+            # treat 1D convolutions as 2D convolutions over a height of 1
+            self.kernel_size = (1, conv.kernel_size[0])
+            self.stride = (1, conv.stride[0])
+            self.padding = (0, conv.padding[0])
+            self.dilation = (1, conv.dilation[0])
+        else:
+            self.kernel_size = tuple(conv.kernel_size)
+            self.stride = tuple(conv.stride)
+            self.padding = tuple(conv.padding)
+            self.dilation = tuple(conv.dilation)
+        self.weight = to_sparse_weight(conv.weight.reshape(conv.out_channels, -1))
+        self.bias = None if conv.bias is None else conv.bias.detach().clone()
+
+    def forward(self, x):
+        if self.dims == 1:
+            x = x.unsqueeze(2)
+        b, _, h, w = x.shape
+        out_h = (h + 2 * self.padding[0] - self.dilation[0] * (self.kernel_size[0] - 1) - 1) // self.stride[0] + 1
+        out_w = (w + 2 * self.padding[1] - self.dilation[1] * (self.kernel_size[1] - 1) - 1) // self.stride[1] + 1
+        if self.kernel_size == (1, 1) and self.stride == (1, 1) and self.padding == (0, 0):
+            cols = x.reshape(b, x.shape[1], -1)
+        else:
+            cols = F.unfold(x, self.kernel_size, dilation=self.dilation, padding=self.padding, stride=self.stride)
+        # one (out, c*k*k) x (c*k*k, l) product per sample keeps every operand contiguous
+        out = torch.stack([torch.sparse.mm(self.weight, col) for col in cols])
+        out = out.reshape(b, self.out_channels, out_h, out_w)
+        if self.bias is not None:
+            out = out + self.bias.view(1, -1, 1, 1)
+        if self.dims == 1:
+            out = out.squeeze(2)
+        return out
+
+
+def to_sparse_module(module):
+    if isinstance(module, nn.Linear):
+        return SparseLinear(module)
+    if isinstance(module, (nn.Conv1d, nn.Conv2d)) and module.groups == 1 and module.padding_mode == 'zeros' \
+            and not isinstance(module.padding, str):
+        return SparseConv(module)
+    return None
+
+
+def capture_inputs(model, names, example_inputs):
+    """Runs `model(*example_inputs)` and returns the input of every module in `names`."""
+    inputs = {}
+    handles = []
+    modules = dict(model.named_modules())
+    for name in names:
+        def hook(module, input, name=name):
+            inputs[name] = input[0]
+        handles.append(modules[name].register_forward_pre_hook(hook))
+    try:
+        model(*example_inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return inputs
+
+
+def time_module(module, x, repeats):
+    module(x)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        module(x)
+    return (time.perf_counter() - start) / repeats
+
+
+@torch.no_grad()
+def sparsify_model(model, min_sparsity=0.5, example_inputs=None, repeats=3):
+    """Replaces, in place, conv and linear layers of `model` that are at least `min_sparsity`
+    sparse by their sparse counterparts. Returns the names of the replaced layers.
+
+    If `example_inputs` are given, every candidate is timed on the input it receives in
+    `model(*example_inputs)` and only replaced if the sparse kernel is faster. Sparse
+    kernels only win at high sparsity, and less so for convolutions which need im2col.
+    """
+    modules = dict(model.named_modules())
+    candidates = {}
+    for name, module in modules.items():
+        if not isinstance(module, (nn.Linear, nn.Conv1d, nn.Conv2d)):
+            continue
+        if weight_sparsity(module.weight) < min_sparsity:
+            continue
+        sparse_module = to_sparse_module(module)
+        if sparse_module is not None:
+            candidates[name] = sparse_module
+
+    inputs = capture_inputs(model, candidates, example_inputs) if example_inputs is not None else {}
+    replaced = []
+    for name, sparse_module in candidates.items():
+        if name in inputs and time_module(sparse_module, inputs[name], repeats) >= \
+                time_module(modules[name], inputs[name], repeats):
+            continue
+        parent_name, _, child_name = name.rpartition('.')
+        setattr(modules[parent_name], child_name, sparse_module)
+        replaced.append(name)
+    return replaced
+
+
+@torch.no_grad()
+def export_sparse_group(model, masking, mask_index, min_sparsity=0.5, example_inputs=None):
+    """Returns a CPU copy of `model` running group `mask_index` of `masking` with sparse kernels.
+
+    `model` has to be the module registered with `masking.add_module`, e.g. the
+    DiffusionWrapper of a LatentDiffusion model. Forward hooks, such as the ones of
+    `Masking.enable_masked_forward`, are not carried over to the copy. See
+    `sparsify_model` for `min_sparsity` and `example_inputs`.
+    """
+    model = copy.deepcopy(model, memo={id(masking): masking}).cpu().eval()
+    for module in model.modules():
+        module._forward_pre_hooks.clear()
+        module._forward_hooks.clear()
+    masks = masking.get_group_masks(mask_index)
+    for name, weight in model.named_parameters():
+        if name in masks:
+            weight.mul_(masks[name].cpu())
+    sparsify_model(model, min_sparsity=min_sparsity, example_inputs=example_inputs)
+    return model
@@ -0,0 +1,62 @@
+# adopted from
+# https://github.com/openai/improved-diffusion/blob/main/improved_diffusion/resample.py
+#
+# thanks!
+
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+
+class LossAwareSampler(nn.Module):
+    """Draws bins (timesteps or groups of timesteps) in proportion to the RMS of their
+    recent losses, like the LossSecondMomentResampler of improved-diffusion.
+
+    `sample` returns the bins together with the weights 1 / (num_bins * p[bin]), weighting
+    the per-sample losses by them keeps their mean an unbiased estimate of the loss under
+    uniform bins. Every bin keeps its last `history` entries, one per `update` that saw the
+    bin, in a buffer on the device. Bins are drawn uniformly until every bin has a full
+    history, and a share of `uniform_prob` always stays uniform.
+
+    The history is not saved in checkpoints, so resumed runs sample uniformly until it is
+    filled again. `update` gathers the losses of all ranks, the histories stay the same
+    on every rank and so do the drawn bins.
+    """
+    def __init__(self, num_bins, history=10, uniform_prob=0.001):
+        super().__init__()
+        self.num_bins = num_bins
+        self.history = history
+        self.uniform_prob = uniform_prob
+        self.register_buffer('losses', torch.zeros(num_bins, history), persistent=False)
+        self.register_buffer('counts', torch.zeros(num_bins, dtype=torch.long), persistent=False)
+
+    def probabilities(self):
+        weights = self.losses.pow(2).mean(dim=-1).sqrt()
+        weights = weights / weights.sum().clamp(min=1e-12)
+        weights = weights * (1 - self.uniform_prob) + self.uniform_prob / self.num_bins
+        uniform = torch.full_like(weights, 1. / self.num_bins)
+        return torch.where((self.counts >= self.history).all(), weights, uniform)
+
+    def sample(self, batch_size):
+        p = self.probabilities()
+        # drawn with the CPU generator like the uniform mask index, so that all ranks draw the same bins
+        bins = torch.multinomial(p.cpu(), batch_size, replacement=True).to(p.device)
+        weights = 1. / (self.num_bins * p[bins])
+        return bins, weights
+
+    @torch.no_grad()
+    def update(self, bins, losses):
+        """Adds the mean loss of the samples of every bin in `bins` to its history."""
+        bins, losses = bins.long(), losses.detach().float()
+        if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            gathered_bins = [torch.empty_like(bins) for _ in range(dist.get_world_size())]
+            gathered_losses = [torch.empty_like(losses) for _ in range(dist.get_world_size())]
+            dist.all_gather(gathered_bins, bins)
+            dist.all_gather(gathered_losses, losses)
+            bins, losses = torch.cat(gathered_bins), torch.cat(gathered_losses)
+        bins, inverse = bins.unique(return_inverse=True)
+        sums = losses.new_zeros(len(bins)).index_add_(0, inverse, losses)
+        sizes = losses.new_zeros(len(bins)).index_add_(0, inverse, torch.ones_like(losses))
+        self.losses[bins, self.counts[bins] % self.history] = sums / sizes
+        self.counts[bins] += 1
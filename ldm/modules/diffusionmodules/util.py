@@ -10,9 +10,11 @@
 
 import os
 import math
+import weakref
 import torch
 import torch.nn as nn
 import numpy as np
+from contextlib import ExitStack
 from einops import repeat
 
 from ldm.util import instantiate_from_config
@@ -116,12 +118,32 @@ def checkpoint(func, inputs, params, flag):
         return func(*inputs)
 
 
+# weak references to bound methods returning a context manager, see register_checkpoint_context
+_checkpoint_contexts = []
+
+
+def register_checkpoint_context(method):
+    """
+    Registers a bound method that captures state a checkpointed function reads besides
+    its inputs and parameters. It is called in the forward pass and has to return a
+    context manager, which is entered around the recomputation in the backward pass.
+    The method is held weakly and dropped together with its object.
+    """
+    _checkpoint_contexts.append(weakref.WeakMethod(method))
+
+
+def checkpoint_contexts():
+    _checkpoint_contexts[:] = [ref for ref in _checkpoint_contexts if ref() is not None]
+    return [ref()() for ref in _checkpoint_contexts]
+
+
 class CheckpointFunction(torch.autograd.Function):
     @staticmethod
     def forward(ctx, run_function, length, *args):
         ctx.run_function = run_function
         ctx.input_tensors = list(args[:length])
         ctx.input_params = list(args[length:])
+        ctx.contexts = checkpoint_contexts()
 
         with torch.no_grad():
             output_tensors = ctx.run_function(*ctx.input_tensors)
@@ -130,7 +152,9 @@ class CheckpointFunction(torch.autograd.Function):
     @staticmethod
     def backward(ctx, *output_grads):
         ctx.input_tensors = [x.detach().requires_grad_(True) for x in ctx.input_tensors]
-        with torch.enable_grad():
+        with torch.enable_grad(), ExitStack() as stack:
+            for context in ctx.contexts:
+                stack.enter_context(context)
             # Fixes a bug where the first op in run_function modifies the
             # Tensor storage in place, which is not allowed for detach()'d
             # Tensors.
@@ -144,6 +168,7 @@ class CheckpointFunction(torch.autograd.Function):
         )
         del ctx.input_tensors
         del ctx.input_params
+        del ctx.contexts
         del output_tensors
         return (None, None) + input_grads
 
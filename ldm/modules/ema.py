@@ -52,14 +52,19 @@ class LitEma(nn.Module):
             else:
                 assert not key in self.m_name2s_name
 
-    def store(self, parameters):
+    def store(self, parameters, device=None):
         """
         Save the current parameters for restoring later.
         Args:
           parameters: Iterable of `torch.nn.Parameter`; the parameters to be
             temporarily stored.
+          device: where to keep the copies, e.g. "cpu" to keep them off the
+            accelerator. The device of every parameter by default.
         """
-        self.collected_params = [param.clone() for param in parameters]
+        if device is None:
+            self.collected_params = [param.clone() for param in parameters]
+        else:
+            self.collected_params = [param.detach().to(device, copy=True) for param in parameters]
 
     def restore(self, parameters):
         """
@@ -74,3 +79,33 @@ class LitEma(nn.Module):
         """
         for c_param, param in zip(self.collected_params, parameters):
             param.data.copy_(c_param.data)
+
+
+def update_emas(emas, models):
+    """`LitEma.forward` of several models at once.
+
+    The shadows of all models with the same decay are updated by two multi-tensor ops,
+    instead of one update per parameter and model, where torch provides them.
+    """
+    groups = {}
+    with torch.no_grad():
+        for ema, model in zip(emas, models):
+            decay = float(ema.decay)
+            if ema.num_updates >= 0:
+                ema.num_updates += 1
+                num_updates = int(ema.num_updates)
+                decay = min(decay, (1 + num_updates) / (10 + num_updates))
+            shadows, params = groups.setdefault(decay, ([], []))
+            shadow_params = dict(ema.named_buffers())
+            for name, param in model.named_parameters():
+                if param.requires_grad:
+                    shadows.append(shadow_params[ema.m_name2s_name[name]])
+                    params.append(param)
+
+        for decay, (shadows, params) in groups.items():
+            if hasattr(torch, '_foreach_mul_'):
+                torch._foreach_mul_(shadows, decay)
+                torch._foreach_add_(shadows, params, alpha=1.0 - decay)
+            else:
+                for shadow, param in zip(shadows, params):
+                    shadow.mul_(decay).add_(param, alpha=1.0 - decay)
@@ -0,0 +1,82 @@
+import argparse, os, sys, time
+import torch
+
+sys.path.append(os.getcwd())
+
+from ldm.modules.diffusionmodules.openaimodel import UNetModel
+from ldm.models.diffusion.sparse_core import Masking
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark of the Masking operations (init, apply, truncate and "
+                                                 "group switches) on a small UNet, on CPU unless told otherwise")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--num_mask", type=int, default=10)
+    parser.add_argument("--density", type=float, default=0.3)
+    parser.add_argument("--prune_rate", type=float, default=0.3)
+    parser.add_argument("--model_channels", type=int, default=64)
+    parser.add_argument("--image_size", type=int, default=32)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--flat_buffers", action="store_true")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=None)
+    return parser
+
+
+def build_unet(opt):
+    return UNetModel(image_size=opt.image_size, in_channels=3, out_channels=3, model_channels=opt.model_channels,
+                     attention_resolutions=[4, 2], num_res_blocks=1, channel_mult=[1, 2, 2],
+                     num_head_channels=32).to(opt.device)
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_call(func, repeats, device):
+    func()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    synchronize(device)
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == "__main__":
+    opt = get_parser().parse_args()
+    if opt.threads is not None:
+        torch.set_num_threads(opt.threads)
+    torch.manual_seed(0)
+
+    model = build_unet(opt)
+    mask = Masking(None, train_loader=None, prune_mode='magnitude', prune_rate_decay=None, growth_mode='gradient',
+                   redistribution_mode=None, fix=False, fp16=False, sparse_init='ERK', init_density=opt.density,
+                   num_mask=opt.num_mask, prune_rate=opt.prune_rate, update_frequency=1,
+                   flat_buffers=opt.flat_buffers)
+    mask.add_module(model)
+    numel = sum(m.numel() for m in mask.masks.values())
+    print(f"{len(mask.masks)} masked layers, {numel / 1e6:.1f}M weights on {mask.device}")
+
+    start = time.perf_counter()
+    mask.init(mode='ERK', density=opt.density, mask_index=0)
+    synchronize(opt.device)
+    print(f"init of {opt.num_mask} groups: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    x = torch.randn(opt.batch_size, 3, opt.image_size, opt.image_size, device=opt.device)
+    t = torch.randint(0, 1000, (opt.batch_size,), device=opt.device)
+    model(x, t).square().mean().backward()
+
+    print(f"apply_mask: {time_call(mask.apply_mask, opt.repeats, opt.device) * 1000:.2f} ms")
+
+    def truncate():
+        # every repetition prunes and regrows the same fraction of the current masks
+        mask.truncate_weights()
+        mask.apply_mask()
+    print(f"truncate_weights: {time_call(truncate, opt.repeats, opt.device) * 1000:.2f} ms")
+
+    groups = iter(range(10 ** 9))
+    def switch():
+        mask.switch_mask(next(groups) % opt.num_mask)
+    print(f"switch_mask: {time_call(switch, opt.repeats, opt.device) * 1000:.2f} ms")
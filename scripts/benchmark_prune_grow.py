@@ -0,0 +1,98 @@
+import argparse, os, sys, math, time
+import torch
+
+sys.path.append(os.getcwd())
+
+from ldm.models.diffusion.funcs import topk_indices, prune_scores, growth_scores, batched_topk_masks
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the RigL prune/grow selection: "
+                                                 "full sorts against topk, per layer and batched over layers")
+    parser.add_argument("--model_channels", type=int, default=128)
+    parser.add_argument("--channel_mult", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("--num_res_blocks", type=int, default=2)
+    parser.add_argument("--density", type=float, default=0.3)
+    parser.add_argument("--prune_rate", type=float, default=0.3)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser
+
+
+def unet_like_shapes(opt):
+    """Conv weight shapes of a UNet encoder/decoder with the given channel multipliers."""
+    shapes = []
+    chs = [opt.model_channels * mult for mult in opt.channel_mult]
+    prev = opt.model_channels
+    for ch in chs + chs[::-1]:
+        for _ in range(opt.num_res_blocks):
+            shapes += [(ch, prev, 3, 3), (ch, ch, 3, 3)]
+            if prev != ch:
+                shapes.append((ch, prev, 1, 1))
+            prev = ch
+        shapes += [(ch, ch), (3 * ch, ch), (ch, ch)]
+    return shapes
+
+
+def sort_prune_grow(layers, prune_rate):
+    # the selection as it was done with full sorts, one layer at a time
+    for weight, mask, grad in layers:
+        nonzeros = mask.sum().item()
+        k = math.ceil(mask.numel() - nonzeros + math.ceil(prune_rate * nonzeros))
+        new_mask = mask.clone()
+        x, idx = torch.sort(torch.abs(weight.view(-1)))
+        new_mask.view(-1)[idx[:k]] = 0
+        regrowth = nonzeros - new_mask.sum().item()
+        all_ind = torch.arange(grad.numel(), device=grad.device).view(grad.shape)
+        select_ind = all_ind[new_mask == 0]
+        y, idx = torch.sort(torch.abs(grad[new_mask == 0]), descending=True)
+        new_mask.view(-1)[select_ind[idx[:regrowth]]] = 1
+
+
+def topk_prune_grow(layers, prune_rate):
+    for weight, mask, grad in layers:
+        nonzeros = mask.sum().item()
+        k = math.ceil(mask.numel() - nonzeros + math.ceil(prune_rate * nonzeros))
+        new_mask = torch.zeros_like(mask)
+        new_mask.view(-1)[topk_indices(prune_scores(mask, weight), mask.numel() - k)] = 1
+        regrowth = nonzeros - new_mask.sum().item()
+        new_mask.view(-1)[topk_indices(growth_scores(new_mask, grad), regrowth)] = 1
+
+
+def batched_prune_grow(layers, prune_rate):
+    weights, masks, grads = zip(*layers)
+    nonzeros = torch.stack([mask.sum() for mask in masks]).tolist()
+    num_keeps = [n - math.ceil(prune_rate * n) for n in nonzeros]
+    new_masks = batched_topk_masks([prune_scores(m, w) for m, w in zip(masks, weights)], num_keeps)
+    remaining = torch.stack([mask.sum() for mask in new_masks]).tolist()
+    regrowth = [n - r for n, r in zip(nonzeros, remaining)]
+    grown = batched_topk_masks([growth_scores(m, g) for m, g in zip(new_masks, grads)], regrowth)
+    [mask | grow for mask, grow in zip(new_masks, grown)]
+
+
+def time_func(func, layers, prune_rate, repeats, device):
+    func(layers, prune_rate)
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func(layers, prune_rate)
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == "__main__":
+    opt = get_parser().parse_args()
+    torch.manual_seed(0)
+    layers = []
+    for shape in unet_like_shapes(opt):
+        mask = torch.rand(shape, device=opt.device) < opt.density
+        weight = torch.randn(shape, device=opt.device) * mask
+        layers.append((weight, mask, torch.randn(shape, device=opt.device)))
+    numel = sum(weight.numel() for weight, _, _ in layers)
+    print(f"{len(layers)} layers, {numel / 1e6:.1f}M weights on {opt.device}")
+
+    for label, func in [("sort, per layer", sort_prune_grow), ("topk, per layer", topk_prune_grow),
+                        ("topk, batched", batched_prune_grow)]:
+        print(f"{label}: {time_func(func, layers, opt.prune_rate, opt.repeats, opt.device) * 1000:.1f} ms per update")
@@ -0,0 +1,131 @@
+import argparse, os, sys, copy, time
+import torch
+
+sys.path.append(os.getcwd())
+
+from ldm.modules.diffusionmodules.openaimodel import UNetModel
+from ldm.models.diffusion.sparse_inference import sparsify_model, export_sparse_group
+from ldm.models.diffusion.sparse_core import Masking
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="CPU benchmark of the sparse UNet runtime against the dense UNet")
+    parser.add_argument("--densities", type=float, nargs="+", default=[0.5, 0.2, 0.1, 0.05],
+                        help="mask densities of the conv and linear layers")
+    parser.add_argument("--min_sparsity", type=float, default=0.5,
+                        help="layers below this sparsity stay dense")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--image_size", type=int, default=32)
+    parser.add_argument("--model_channels", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=10,
+                        help="timed forward passes per model, after one warmup pass")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--no_calibration", action="store_true",
+                        help="replace every layer above min_sparsity instead of only the ones that run faster sparse")
+    parser.add_argument("--num_groups", type=int, default=0,
+                        help="also time a sampling loop over this many group masks of a Masking, switching masks "
+                             "against swapping in the exported sparse group UNets as the samplers do with sparse_kernels")
+    parser.add_argument("--steps", type=int, default=20,
+                        help="sampling steps of the group loop, spread evenly over the groups")
+    return parser
+
+
+@torch.no_grad()
+def build_unet(opt):
+    model = UNetModel(image_size=opt.image_size, in_channels=3, out_channels=3, model_channels=opt.model_channels,
+                      attention_resolutions=[4, 2], num_res_blocks=1, channel_mult=[1, 2, 2],
+                      num_head_channels=32).eval()
+    # zero-initialized output layers would hide any error of the sparse kernels
+    for weight in model.parameters():
+        if weight.dim() > 1 and not weight.any():
+            weight.normal_(std=0.02)
+    return model
+
+
+@torch.no_grad()
+def prune(model, density):
+    # same layers as Masking.add_module: conv/linear weights, without the embeddings
+    for name, weight in model.named_parameters():
+        if weight.dim() in [2, 4] and 'time_embed' not in name and 'label_emb' not in name:
+            weight.mul_(torch.rand(weight.shape) < density)
+
+
+def make_masking(model, num_groups, density):
+    masking = Masking(None, train_loader=None, prune_mode='magnitude', prune_rate_decay=None, growth_mode='random',
+                      redistribution_mode=None, fix=True, fp16=False, sparse_init='ERK', init_density=density,
+                      num_mask=num_groups, generator_device='cpu')
+    masking.add_module(model)
+    masking.init(mode='ERK', density=density, mask_index=0)
+    return masking
+
+
+@torch.no_grad()
+def time_group_sampling(model, masking, x, t, opt):
+    """Times `opt.steps` forward passes that run through the groups in order, once switching
+    the masks of the dense UNet and once with the sparse UNet of every group, exported once
+    ahead of the timed loop."""
+    groups = [step * opt.num_groups // opt.steps for step in range(opt.steps)][::-1]
+    masking.store_weights()
+    start = time.perf_counter()
+    dense_outs = {}
+    for group in groups:
+        masking.activate_mask(group)
+        dense_outs[group] = model(x, t)
+    dense_time = time.perf_counter() - start
+    masking.restore_weights()
+
+    start = time.perf_counter()
+    exported = {group: export_sparse_group(model, masking, group, min_sparsity=opt.min_sparsity)
+                for group in sorted(set(groups))}
+    export_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for group in groups:
+        out = exported[group](x, t)
+    sparse_time = time.perf_counter() - start
+    error = max((exported[group](x, t) - dense_outs[group]).abs().max().item() for group in exported)
+    return dense_time, sparse_time, export_time, error
+
+
+@torch.no_grad()
+def time_forward(model, x, t, repeats):
+    model(x, t)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = model(x, t)
+    return (time.perf_counter() - start) / repeats, out
+
+
+if __name__ == "__main__":
+    opt = get_parser().parse_args()
+    if opt.threads is not None:
+        torch.set_num_threads(opt.threads)
+    torch.manual_seed(0)
+
+    base = build_unet(opt)
+    x = torch.randn(opt.batch_size, 3, opt.image_size, opt.image_size)
+    t = torch.randint(0, 1000, (opt.batch_size,))
+
+    dense_time, _ = time_forward(base, x, t, opt.repeats)
+    print(f"dense: {dense_time * 1000:.1f} ms/forward")
+    for density in opt.densities:
+        pruned = copy.deepcopy(base)
+        prune(pruned, density)
+        pruned_time, reference = time_forward(pruned, x, t, opt.repeats)
+        sparse = copy.deepcopy(pruned)
+        example_inputs = None if opt.no_calibration else (x, t)
+        replaced = sparsify_model(sparse, min_sparsity=opt.min_sparsity, example_inputs=example_inputs)
+        sparse_time, out = time_forward(sparse, x, t, opt.repeats)
+        error = (out - reference).abs().max().item()
+        print(f"density {density}: {len(replaced)} sparse layers, dense kernels {pruned_time * 1000:.1f} ms, "
+              f"sparse kernels {sparse_time * 1000:.1f} ms, speedup {pruned_time / sparse_time:.2f}x, "
+              f"max abs error {error:.2e}")
+
+    for density in opt.densities if opt.num_groups else []:
+        model = build_unet(opt)
+        masking = make_masking(model, opt.num_groups, density)
+        dense_time, sparse_time, export_time, error = time_group_sampling(model, masking, x, t, opt)
+        print(f"{opt.num_groups} groups, density {density}: {opt.steps} steps with mask switches "
+              f"{dense_time * 1000:.1f} ms, with sparse group UNets {sparse_time * 1000:.1f} ms "
+              f"(+{export_time * 1000:.1f} ms export), speedup {dense_time / sparse_time:.2f}x, "
+              f"max abs error {error:.2e}")
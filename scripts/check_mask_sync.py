@@ -0,0 +1,44 @@
+import argparse, os, sys, tempfile
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.append(os.getcwd())
+
+from ldm.models.diffusion.sparse_core import broadcast_masks
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Checks the bucketed mask broadcast on CPU with the gloo backend")
+    parser.add_argument("--world_size", type=int, default=3)
+    parser.add_argument("--bucket_bytes", type=int, default=2048,
+                        help="small buckets, so that the masks are split over several broadcasts")
+    return parser
+
+
+def make_masks(seed):
+    # odd sizes, so that packed masks do not end on byte boundaries
+    generator = torch.Generator().manual_seed(seed)
+    shapes = [(64, 32, 3, 3), (13, 7), (128, 64, 1, 1), (5, 3, 3, 3), (320, 320)]
+    return {f'layer{i}.weight': torch.rand(shape, generator=generator) < 0.3 for i, shape in enumerate(shapes)}
+
+
+def run(rank, opt, init_file):
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank, world_size=opt.world_size)
+    masks = make_masks(seed=rank)
+    tensors = {name: mask for name, mask in masks.items()}
+    num_broadcasts = broadcast_masks(masks, src=0, bucket_bytes=opt.bucket_bytes)
+    expected = make_masks(seed=0)
+    for name, mask in masks.items():
+        assert mask is tensors[name], f'{name} was not unpacked in place'
+        assert torch.equal(mask, expected[name]), f'rank {rank}: {name} differs from rank 0'
+    if rank == 0:
+        print(f"{len(masks)} masks synchronized over {opt.world_size} ranks with {num_broadcasts} broadcasts")
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    opt = get_parser().parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mp.spawn(run, args=(opt, os.path.join(tmpdir, 'init')), nprocs=opt.world_size, join=True)
+    print("ok")